@@ -1,20 +1,22 @@
 """
 Reads txt files of all papers and computes tfidf vectors for all papers.
-Dumps results to file tfidf.p
+Dumps results to file tfidf.p, and writes the parts of the bundle read by
+the server (see bundle.py): the same matrix as memory-mappable arrays, the
+vectorizer, an approximate nearest neighbors index and the neighbors of
+every paper.
 """
 import dateutil.parser
 import os
 import pickle
-from collections import namedtuple
 from random import shuffle, seed
 
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
+import scipy.sparse as sp
 
+from bundle import part_path, save_arrays, commit_parts
+from similarity import save_csr, NeighborTable, TextVectorizer, LSHIndex, recall_at_k, make_tfidf_vectorizer, precompute_neighbors, PidConf
 from utils import Config, safe_pickle_dump, load_json_db
 
-PidConf = namedtuple('PidConf', 'pid, name, year, subid')
-
 seed(1337)
 max_train = 50000  # max number of tfidf training documents (chosen randomly), for memory efficiency
 max_features = 5000
@@ -25,6 +27,7 @@ db = load_json_db()
 # read all text files for all papers into memory
 txt_paths, pids = [], []
 pid_confs = []
+abstract_pids = [] # papers without a usable text file, they are represented by their title and abstract instead
 n = 0
 # for pid,j in db.items():
 for key in db:
@@ -33,36 +36,30 @@ for key in db:
     txt_path = os.path.join(
         Config.txt_dir, db[key]['conf_id'], db[key]['conf_sub_id'], 
         basename) + '.txt'
-    if os.path.isfile(txt_path): # some pdfs dont translate to txt
-        pub_year = int(dateutil.parser.parse(db[key]['published']).strftime('%Y'))
-        if not Config.include_workshop_papers and db[key]['is_workshop']:
-            print("skipped %d/%d (%s): not using workshops" % (n, len(db), key))
-        elif pub_year < Config.minimum_year:
-            print("skipped %d/%d (%s): older than minimum year" % (n, len(db), key))
+    pub_year = int(dateutil.parser.parse(db[key]['published']).strftime('%Y'))
+    if not Config.include_workshop_papers and db[key]['is_workshop']:
+        print("skipped %d/%d (%s): not using workshops" % (n, len(db), key))
+    elif pub_year < Config.minimum_year:
+        print("skipped %d/%d (%s): older than minimum year" % (n, len(db), key))
+    elif os.path.isfile(txt_path): # some pdfs dont translate to txt
+        with open(txt_path, 'r') as f:
+            txt = f.read()
+        if len(txt) > 1000 and len(txt) < 500000: # 500K is VERY conservative upper bound
+            txt_paths.append(txt_path) # todo later: maybe filter or something some of them
+            pids.append(key)
+            conf_id = db[key]['conf_id']
+            pid_confs.append(PidConf(key, conf_id[:-4], conf_id[-4:], db[key]['conf_sub_id'].lower()))
+            print("read %d/%d (%s) with %d chars" % (n, len(db), key, len(txt)))
         else:
-            with open(txt_path, 'r') as f:
-                txt = f.read()
-            if len(txt) > 1000 and len(txt) < 500000: # 500K is VERY conservative upper bound
-                txt_paths.append(txt_path) # todo later: maybe filter or something some of them
-                pids.append(key)
-                conf_id = db[key]['conf_id']
-                pid_confs.append(PidConf(key, conf_id[:-4], conf_id[-4:], db[key]['conf_sub_id'].lower()))
-                print("read %d/%d (%s) with %d chars" % (n, len(db), key, len(txt)))
-            else:
-                print("skipped %d/%d (%s) with %d chars: suspicious!" % (n, len(db), key, len(txt)))
-    # else:
-    #     print("could not find %s in txt folder." % (txt_path, ))
+            print("skipped %d/%d (%s) with %d chars: suspicious!" % (n, len(db), key, len(txt)))
+            abstract_pids.append(key)
+    else:
+        # print("could not find %s in txt folder." % (txt_path, ))
+        abstract_pids.append(key)
 print("in total read in %d text files out of %d db entries." % (len(txt_paths), len(db)))
 
 # compute tfidf vectors with scikits
-v = TfidfVectorizer(
-    input='content', 
-    encoding='utf-8', decode_error='replace', strip_accents='unicode', 
-    lowercase=True, analyzer='word', stop_words='english', 
-    token_pattern=r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b',
-    ngram_range=(1, 2), max_features = max_features, 
-    norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=True,
-    max_df=1.0, min_df=1)
+v = make_tfidf_vectorizer(max_features)
 
 
 # create an iterator object to conserve memory
@@ -88,20 +85,41 @@ X = v.transform(corpus)
 print(v.vocabulary_)
 print(X.shape)
 
+# the papers without text are appended after the others, the server can then find their neighbors on demand
+print("transforming the title and abstract of %d documents without text..." % (len(abstract_pids), ))
+X_abstracts = v.transform([db[key]['title'] + '. ' + db[key]['summary'] for key in abstract_pids])
+X_all = sp.vstack([X, X_abstracts]).tocsr()
+all_pids = pids + abstract_pids
+
 # write full matrix out
 out = {}
-out['X'] = X # this one is heavy!
+out['X'] = X_all # this one is heavy!
 print("writing", Config.tfidf_path)
 safe_pickle_dump(out, Config.tfidf_path)
+# and the same matrix as raw arrays that can be memory-mapped
+print("writing", part_path('tfidf'))
+save_csr(X_all, part_path('tfidf'))
 
 # writing lighter metadata information into a separate (smaller) file
 out = {}
 out['vocab'] = v.vocabulary_
 out['idf'] = v._tfidf.idf_
-out['pids'] = pids # a full idvv string (id and version number)
-out['ptoi'] = { x:i for i,x in enumerate(pids) } # pid to ix in X mapping
+out['pids'] = all_pids # a full idvv string (id and version number)
+out['ptoi'] = { x:i for i,x in enumerate(all_pids) } # pid to ix in X mapping
+out['num_txt'] = len(pids) # the first rows come from the full text, the others from the abstracts
 print("writing", Config.meta_path)
 safe_pickle_dump(out, Config.meta_path)
+# the server only needs the pid of each row
+print("writing", part_path('meta'))
+save_arrays(part_path('meta'), {'pids': np.array([pid.encode('utf-8') for pid in all_pids]), 'num_txt': len(pids)})
+# the vectorizer, so that the server can transform new text
+print("writing", part_path('vectorizer'))
+TextVectorizer.from_sklearn(v).save(part_path('vectorizer'))
+# and the approximate nearest neighbors index, used for the large corpora
+print("building the approximate nearest neighbors index...")
+index = LSHIndex.build(X_all)
+print("writing", part_path('ann'))
+index.save(part_path('ann'))
 
 # Find newest year of each conference
 composed_conference_ids = set([(p['conf_id'], dateutil.parser.parse(p['published'])) for pid,p in db.items()])
@@ -113,51 +131,30 @@ for conf_id, conf_year in composed_conference_ids:
         newest_conf_years[conf_name] = conf_year.strftime('%Y')
 
 
-# Counts how many papers in the latest conferences are already in the top picks
-def count_conference_papers(top_pids, newest_conf_years, db):
-    counters = {conf_name: 0 for conf_name in newest_conf_years}
-    for pid in top_pids:
-        conf_id = db[pid]['conf_id']
-        conf_name = conf_id[:-4]
-        conf_year = conf_id[-4:]
-        if db[pid]['conf_sub_id'].lower() == 'main' and conf_year == newest_conf_years[conf_name]:
-            counters[conf_name] += 1
-    return counters
-
-
-# Find more top pids until all latest conferences have at least top_k_by_conf papers in the list
-def get_top_pids_by_conference(top_k, top_k_by_conf, conf_counters, newest_conf_years, sort_idx, pid_confs, db):
-    sorted_pid_confs = [pid_confs[i] for i in sort_idx]
-    filtered_pid_confs = [
-        pc for pc in sorted_pid_confs[top_k:]
-        if pc.subid == 'main' and
-        pc.year == newest_conf_years[pc.name]]
-    conf_top_pids = []
-    for pc in filtered_pid_confs:
-        if conf_counters[pc.name] < top_k_by_conf:
-            conf_top_pids.append(pc.pid)
-            conf_counters[pc.name] += 1
-    return conf_top_pids
-
-
-print("precomputing nearest neighbor queries in batches...")
-X = X.todense() # originally it's a sparse matrix
-sim_dict = {}
-batch_size = 200
 top_k = 500
 top_k_by_conf = 50
-for i in range(0, len(pids), batch_size):
-    i1 = min(len(pids), i+batch_size)
-    xquery = X[i:i1] # BxD
-    ds = -np.asarray(np.dot(X, xquery.T)) #NxD * DxB => NxB
-    IX = np.argsort(ds, axis=0) # NxB
-    for j in range(i1-i):
-        top_pids = [pids[q] for q in list(IX[1:top_k, j])]
-        conf_counters = count_conference_papers(top_pids, newest_conf_years, db)
-        conf_top_pids = get_top_pids_by_conference(top_k, top_k_by_conf, conf_counters, newest_conf_years, IX[:, j], pid_confs, db)
-        top_pids += conf_top_pids
-        sim_dict[pids[i+j]] = top_pids
-    print('%d/%d...' % (i, len(pids)))
-
-print("writing", Config.sim_path)
-safe_pickle_dump(sim_dict, Config.sim_path)
+use_index = False
+if len(pids) >= Config.ann_min_papers:
+    ks = [10, 100, top_k]
+    recalls, num_candidates = recall_at_k(X_all, index, list(range(0, len(pids), max(1, len(pids) // 100))), ks)
+    print("approximate nearest neighbors, %.0f candidates per paper, recall %s" % (
+        num_candidates, ', '.join('@%d: %.3f' % (k, r) for k, r in zip(ks, recalls))))
+    # the stored neighbors are only approximated when the index finds nearly all of them
+    use_index = recalls[-1] >= Config.ann_min_recall
+    if not use_index:
+        print("recall@%d is below %.2f, using the exact search instead (see ann_report.py to tune the index)" % (
+            top_k, Config.ann_min_recall))
+if use_index:
+    print("finding nearest neighbors with the approximate index...")
+    neighbors = precompute_neighbors(X, pid_confs, newest_conf_years, top_k, top_k_by_conf, index=index)
+else:
+    print("precomputing nearest neighbor queries in batches...")
+    # only the papers with full text are used here
+    neighbors = precompute_neighbors(X, pid_confs, newest_conf_years, top_k, top_k_by_conf)
+
+# the neighbors of row i of the tfidf matrix (the papers with full text) are in row i
+print("writing", part_path('neighbors'))
+NeighborTable.save(part_path('neighbors'), *neighbors)
+
+# and last, the parts are moved together to the staging folder, where make_cache.py completes the bundle
+commit_parts()
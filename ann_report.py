@@ -0,0 +1,63 @@
+"""
+Measures the recall@k of the approximate nearest neighbors index against the
+exact neighbors, for a grid of index parameters, to choose the trade-off
+between the quality of the neighbors and the number of papers scored.
+
+this script should be run after analyze.py, it reads the memory-mapped tfidf
+matrix. Pass --save to write the index with the chosen parameters to
+the bundle, which is then published for serve.py if make_cache.py already
+wrote a manifest.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from bundle import part_path, staged_part_path, commit_parts, write_manifest, MANIFEST_NAME
+from similarity import load_csr, similar_rows, LSHIndex, recall_at_k
+from utils import Config
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tables', type=int, nargs='+', default=[8, 16, 32], help='numbers of hash tables')
+parser.add_argument('--bits', type=int, nargs='+', default=None, help='numbers of bits per table (default: around the size of the corpus)')
+parser.add_argument('--probes', type=int, nargs='+', default=[0, 2, 4], help='numbers of neighboring buckets probed per table')
+parser.add_argument('--ks', type=int, nargs='+', default=[10, 100, 500], help='k of the recall@k')
+parser.add_argument('--queries', type=int, default=200, help='number of papers used as queries')
+parser.add_argument('--save', type=int, nargs=3, metavar=('TABLES', 'BITS', 'PROBES'), help='write the index with these parameters')
+args = parser.parse_args()
+
+X = load_csr(staged_part_path('tfidf'))
+print('%d papers, %d terms' % X.shape)
+if args.save:
+    n_tables, n_bits, n_probes = args.save
+    print("writing", part_path('ann'))
+    LSHIndex.build(X, n_tables, n_bits, n_probes).save(part_path('ann'))
+    if os.path.isfile(os.path.join(Config.bundle_dir, MANIFEST_NAME)):
+        write_manifest()
+    else:
+        commit_parts()
+    raise SystemExit
+
+queries = np.random.RandomState(0).choice(X.shape[0], min(args.queries, X.shape[0]), replace=False)
+t0 = time.time()
+for row in queries:
+    similar_rows(X, X[row], max(args.ks), exclude=[row])
+print('exact search: %.2f ms/query' % (1000.0 * (time.time() - t0) / len(queries)))
+default_bits = LSHIndex.default_bits(X.shape[0])
+bits = args.bits or sorted(set(max(1, default_bits + d) for d in (-2, 0, 2)))
+
+print('tables  bits  probes  candidates  ms/query  ' + '  '.join('recall@%-4d' % k for k in args.ks))
+for n_tables in args.tables:
+    for n_bits in bits:
+        index = LSHIndex.build(X, n_tables, n_bits)
+        for n_probes in args.probes:
+            index.n_probes = min(n_probes, n_bits)
+            recalls, num_candidates = recall_at_k(X, index, queries, args.ks)
+            t0 = time.time()
+            for row in queries:
+                similar_rows(X, X[row], max(args.ks), exclude=[row], index=index)
+            ms = 1000.0 * (time.time() - t0) / len(queries)
+            print('%6d  %4d  %6d  %10.0f  %8.2f  ' % (n_tables, n_bits, n_probes, num_candidates, ms) +
+                  '  '.join('%-11.3f' % r for r in recalls))
@@ -0,0 +1,263 @@
+"""
+Load test of serve.py on a synthetic corpus, to catch the scaling regressions
+before deploying. Everything runs locally, without network access.
+
+A work folder gets a copy of the code and a synthetic database of --papers
+papers (see synthetic.py), on which analyze.py and make_cache.py are run.
+Then serve.py is started there, and concurrent clients request /, /search and
+/<pid> for --duration seconds. The report has the latency percentiles and the
+throughput of each route, and the memory used by the server.
+
+example:
+python benchmarks/load_test.py --papers 100000 --clients 32 --duration 60 --output report.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.append(BENCH_DIR)
+import synthetic
+
+# what is copied to the work folder (the thumbnails are not needed)
+CODE_DIRS = ['templates', 'static']
+ROUTES = ['home', 'search', 'paper']
+
+
+def copy_code(workdir):
+    for f in os.listdir(ROOT_DIR):
+        if f.endswith('.py'):
+            shutil.copy2(os.path.join(ROOT_DIR, f), workdir)
+    for d in CODE_DIRS:
+        shutil.rmtree(os.path.join(workdir, d), ignore_errors=True)
+        shutil.copytree(os.path.join(ROOT_DIR, d), os.path.join(workdir, d), ignore=shutil.ignore_patterns('thumbs'))
+
+
+def run_step(args, workdir, log_name):
+    """ Runs a script of the pipeline in the work folder, its output goes to a log file. Returns its duration. """
+    print('running', ' '.join(args))
+    t0 = time.time()
+    with open(os.path.join(workdir, log_name), 'w') as log:
+        subprocess.run([sys.executable] + args, cwd=workdir, stdout=log, stderr=subprocess.STDOUT, check=True)
+    return time.time() - t0
+
+
+def prepare(workdir, args):
+    """ Writes the corpus and runs the pipeline in the work folder, unless they are there from a previous
+    run with the same corpus. Returns the durations of the steps that were run. """
+    os.makedirs(workdir, exist_ok=True)
+    copy_code(workdir)
+    corpus = {'papers': args.papers, 'seed': args.seed, 'text_words': args.text_words}
+    corpus_path = os.path.join(workdir, 'corpus.json')
+    same_corpus = os.path.isfile(corpus_path) and json.load(open(corpus_path)) == corpus
+    times = {}
+    if not same_corpus:
+        shutil.rmtree(os.path.join(workdir, 'data'), ignore_errors=True)
+        print('generating {:d} papers in {:}'.format(args.papers, workdir))
+        t0 = time.time()
+        synthetic.generate(workdir, args.papers, seed=args.seed, text_words=args.text_words)
+        times['generate'] = time.time() - t0
+    if not (same_corpus and args.reuse_bundle):
+        times['analyze'] = run_step(['analyze.py'], workdir, 'analyze.log')
+        times['make_cache'] = run_step(['make_cache.py'], workdir, 'make_cache.log')
+        with open(corpus_path, 'w') as f:
+            json.dump(corpus, f)
+    return times
+
+
+def load_targets(workdir, n, rng):
+    """ Samples the pids requested by the clients, and search queries made of words of their titles. """
+    json_dir = os.path.join(workdir, 'data', 'json')
+    papers = []
+    for f in sorted(os.listdir(json_dir)):
+        papers.extend((pid, p['title']) for pid, p in json.load(open(os.path.join(json_dir, f))).items())
+    papers = rng.sample(papers, min(n, len(papers)))
+    queries = []
+    for _, title in papers:
+        words = title.lower().split()
+        i = rng.randrange(len(words))
+        queries.append(' '.join(words[i:i + rng.randint(1, 3)]))
+    return [pid for pid, _ in papers], queries
+
+
+def children(pid):
+    out = []
+    for d in os.listdir('/proc'):
+        if d.isdigit():
+            try:
+                with open('/proc/{:}/stat'.format(d)) as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        out.append(int(d))
+            except (OSError, IndexError, ValueError):
+                pass
+    return out
+
+
+def rss_bytes(pid):
+    """ The resident memory of a process and of its children (e.g. with serve.py --processes), on Linux. The
+    pages shared by the processes, like those of the memory-mapped bundle, are only counted once (the
+    proportional set size), except on the kernels without /proc/<pid>/smaps_rollup. """
+    total = 0
+    for p in [pid] + children(pid):
+        for name, field in [('smaps_rollup', 'Pss:'), ('status', 'VmRSS:')]:
+            try:
+                with open('/proc/{:d}/{:}'.format(p, name)) as f:
+                    total += next(int(line.split()[1]) * 1024 for line in f if line.startswith(field))
+                break
+            except (OSError, StopIteration):
+                pass
+    return total
+
+
+def start_server(workdir, port, serve_args, timeout):
+    log = open(os.path.join(workdir, 'serve.log'), 'w')
+    server = subprocess.Popen([sys.executable, 'serve.py', '--port', str(port)] + serve_args,
+                              cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        if server.poll() is not None:
+            raise RuntimeError('serve.py exited, see {:}'.format(log.name))
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:{:d}/api/startup'.format(port)) as r:
+                startup = json.load(r)
+            return server, startup, time.time() - t0
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('serve.py did not answer in {:}s'.format(timeout))
+
+
+def client(base_url, pids, queries, weights, deadline, warmup_end, seed, results):
+    """ Sends requests until the deadline, and appends (route, seconds, ok) to results after the warmup. """
+    rng = random.Random(seed)
+    while True:
+        route = rng.choices(ROUTES, weights)[0]
+        if route == 'home':
+            url = base_url + '/'  # redirected to the newest conference
+        elif route == 'search':
+            url = base_url + '/search?' + urllib.parse.urlencode({'q': rng.choice(queries)})
+        else:
+            url = base_url + '/' + urllib.parse.quote(rng.choice(pids))
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url) as r:
+                r.read()
+            ok = True
+        except (urllib.error.URLError, ConnectionError):
+            ok = False
+        t1 = time.perf_counter()
+        now = time.time()
+        if now > deadline:
+            return
+        if now > warmup_end:
+            results.append((route, t1 - t0, ok))
+
+
+def summarize(results, duration):
+    report = {}
+    for route in ROUTES + ['all']:
+        rs = [r for r in results if route == 'all' or r[0] == route]
+        seconds = np.array([s for _, s, ok in rs if ok])
+        report[route] = {
+            'requests': len(rs), 'errors': sum(1 for r in rs if not r[2]),
+            'throughput': round(len(seconds) / duration, 2)}
+        if len(seconds):
+            p50, p95, p99 = np.percentile(seconds, [50, 95, 99]) * 1000
+            report[route].update({'p50_ms': round(p50, 2), 'p95_ms': round(p95, 2), 'p99_ms': round(p99, 2),
+                                  'max_ms': round(seconds.max() * 1000, 2)})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, default=10000, help='number of papers of the synthetic corpus')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic corpus')
+    parser.add_argument('--text-words', dest='text_words', type=int, default=1500, help='words in the full text of a paper')
+    parser.add_argument('--workdir', type=str, default=None, help='work folder (default: one per corpus size in the temp folder)')
+    parser.add_argument('--reuse-bundle', dest='reuse_bundle', action='store_true',
+                        help='do not run analyze.py and make_cache.py again if the corpus did not change')
+    parser.add_argument('--clients', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of measurements')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of requests before the measurements')
+    parser.add_argument('--mix', type=float, nargs=3, default=[1, 3, 3], metavar=('HOME', 'SEARCH', 'PAPER'),
+                        help='relative frequencies of the requests to /, /search and /<pid>')
+    parser.add_argument('--port', type=int, default=5123)
+    parser.add_argument('--serve-args', dest='serve_args', type=str, default='--prod', help='arguments of serve.py')
+    parser.add_argument('--output', type=str, default=None, help='write the report to this JSON file')
+    args = parser.parse_args()
+
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), 'similarpapers_bench_{:d}'.format(args.papers))
+    pipeline = prepare(workdir, args)
+    pids, queries = load_targets(workdir, 10000, random.Random(args.seed))
+
+    server, startup, ready_seconds = start_server(workdir, args.port, args.serve_args.split(), timeout=600)
+    try:
+        rss_start = rss_bytes(server.pid)
+        rss_peak = [rss_start]
+        stop = threading.Event()
+
+        def watch_memory():
+            while not stop.wait(0.5):
+                rss_peak[0] = max(rss_peak[0], rss_bytes(server.pid))
+        watcher = threading.Thread(target=watch_memory, daemon=True)
+        watcher.start()
+
+        print('{:d} clients for {:.0f}s (+{:.0f}s of warmup)'.format(args.clients, args.duration, args.warmup))
+        results = []
+        warmup_end = time.time() + args.warmup
+        deadline = warmup_end + args.duration
+        base_url = 'http://127.0.0.1:{:d}'.format(args.port)
+        clients = [threading.Thread(target=client, args=(base_url, pids, queries, args.mix, deadline, warmup_end, i, results))
+                   for i in range(args.clients)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        stop.set()
+        rss_end = rss_bytes(server.pid)
+    finally:
+        workers = children(server.pid)
+        server.terminate()
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        server.wait()
+
+    report = {
+        'papers': args.papers, 'clients': args.clients, 'duration': args.duration, 'serve_args': args.serve_args,
+        'pipeline_seconds': {k: round(v, 2) for k, v in pipeline.items()},
+        'startup_seconds': startup['startup_seconds'], 'ready_seconds': round(ready_seconds, 2),
+        'rss_mb': {'start': round(rss_start / 2**20, 1), 'peak': round(rss_peak[0] / 2**20, 1), 'end': round(rss_end / 2**20, 1)},
+        'routes': summarize(results, args.duration),
+    }
+    print('pipeline: ' + ', '.join('{:} {:.1f}s'.format(k, v) for k, v in pipeline.items()) if pipeline else 'pipeline: reused')
+    print('server: ready in {:.2f}s, rss {start:.1f} MB at start, {peak:.1f} MB peak, {end:.1f} MB at the end'.format(
+        ready_seconds, **report['rss_mb']))
+    print('route     requests  errors   req/s     p50 ms    p95 ms    p99 ms    max ms')
+    for route, r in report['routes'].items():
+        print('{:8s}  {:8d}  {:6d}  {:7.1f}  '.format(route, r['requests'], r['errors'], r['throughput']) +
+              '  '.join('{:8.2f}'.format(r[k]) if k in r else '       -' for k in ['p50_ms', 'p95_ms', 'p99_ms', 'max_ms']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
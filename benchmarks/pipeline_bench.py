@@ -0,0 +1,175 @@
+"""
+Micro-benchmarks of the stages of the offline pipeline, on a fixed synthetic
+corpus (see synthetic.py), compared to the baseline timings stored in
+benchmarks/baselines.json, to notice a stage getting slower before a full
+rebuild takes hours longer.
+
+The stages are timed in this process: load_json_db, the TF-IDF fit and
+transform of analyze.py, the neighbors loop (exact and with the approximate
+index), the makedict index of make_cache.py and dump_db_as_json. Each stage
+runs --repeat times (the short ones in a loop) and its best time is kept. The
+timings are divided by the time of a fixed calibration workload, so that the
+baselines stay meaningful on other machines, and a stage is a regression when
+its ratio to the calibration grew more than --tolerance over the baseline. The
+exit status is then 1.
+
+example:
+python benchmarks/pipeline_bench.py                   # compare to the baselines
+python benchmarks/pipeline_bench.py --save-baseline   # after an intended change
+"""
+
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import redirect_stdout
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BENCH_DIR))
+sys.path.append(BENCH_DIR)
+import synthetic
+from similarity import LSHIndex, PidConf, make_tfidf_vectorizer, precompute_neighbors
+from utils import Config, dump_db_as_json, load_json_db, make_search_dict
+
+BASELINES_PATH = os.path.join(BENCH_DIR, 'baselines.json')
+# words of the full text of every paper, shorter than the real ones to keep the benchmarks short
+TEXT_WORDS = 500
+
+
+def calibration():
+    """ A fixed mix of interpreted Python and numpy work, like the stages. """
+    d = {}
+    for i in range(300000):
+        d[str(i % 5000)] = d.get(str(i % 5000), 0) + i
+    a = np.random.RandomState(0).random_sample((400, 400))
+    for _ in range(5):
+        a = np.argsort(a.dot(a.T), axis=0).astype(np.float64) / 400.0
+    return d, a
+
+
+def best_time(fn, repeat, min_seconds=0.5):
+    """ The best time of a call of fn over repeat samples. The short stages are called several times in
+    every sample, so that a sample lasts at least min_seconds and the timer noise does not matter. The
+    garbage collector is disabled meanwhile, like timeit does. """
+    best = None
+    number = 1
+    gc.collect()
+    gc.disable()
+    try:
+        with redirect_stdout(io.StringIO()): # the progress messages of the stages
+            for _ in range(repeat):
+                while True:
+                    t0 = time.perf_counter()
+                    for _ in range(number):
+                        fn()
+                    t = time.perf_counter() - t0
+                    if t >= min_seconds or number >= 1000:
+                        break
+                    number *= 2
+                best = t / number if best is None else min(best, t / number)
+    finally:
+        gc.enable()
+    return best
+
+
+def run_stages(workdir, repeat):
+    """ Times the stages on the corpus in workdir, returns the seconds of each. """
+    Config.json_dir = os.path.join(workdir, 'data', 'json')
+    times = OrderedDict()
+    # every ratio depends on it, so it gets more samples
+    times['calibration'] = best_time(calibration, 3 * repeat)
+
+    times['load_json_db'] = best_time(load_json_db, repeat)
+    db = load_json_db()
+
+    # the papers with a full text, read in memory so that only the computation is timed
+    texts, pid_confs = [], []
+    for pid, p in db.items():
+        txt_path = os.path.join(workdir, 'data', 'txt', p['conf_id'], p['conf_sub_id'], p['pdf_url'].split('/')[-1]) + '.txt'
+        if os.path.isfile(txt_path):
+            with open(txt_path, 'r') as f:
+                texts.append(f.read())
+            pid_confs.append(PidConf(pid, p['conf_id'][:-4], p['conf_id'][-4:], p['conf_sub_id'].lower()))
+    times['tfidf_fit'] = best_time(lambda: make_tfidf_vectorizer().fit(texts), repeat)
+    v = make_tfidf_vectorizer().fit(texts)
+    times['tfidf_transform'] = best_time(lambda: v.transform(texts), repeat)
+    X = v.transform(texts)
+
+    newest_conf_years = {}
+    for pc in pid_confs:
+        newest_conf_years[pc.name] = max(newest_conf_years.get(pc.name, pc.year), pc.year)
+    times['neighbors_exact'] = best_time(lambda: precompute_neighbors(X, pid_confs, newest_conf_years), repeat)
+    index = LSHIndex.build(X)
+    times['neighbors_ann'] = best_time(lambda: precompute_neighbors(X, pid_confs, newest_conf_years, index=index), repeat)
+
+    # decorated as make_cache.py does before building the index
+    for p in db.values():
+        p['composed_conf_id'] = p['conf_id'] + ('W' if p['is_workshop'] else '') + ('_'+p['conf_sub_id'] if p['is_workshop'] else '')
+    times['makedict_index'] = best_time(lambda: make_search_dict(db, v.vocabulary_, v.idf_), repeat)
+
+    for p in db.values():
+        del p['composed_conf_id']
+    Config.json_dir = os.path.join(workdir, 'dump')
+    times['dump_db_as_json'] = best_time(lambda: dump_db_as_json(db), repeat)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, default=1000, help='number of papers of the synthetic corpus')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each stage, the best time is kept')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown flagged as a regression')
+    parser.add_argument('--save-baseline', dest='save_baseline', action='store_true', help='store the timings as the new baselines')
+    args = parser.parse_args()
+
+    # the corpus is only written once for every size, its content is fixed by the seed
+    workdir = os.path.join(tempfile.gettempdir(), 'similarpapers_pipeline_bench_{:d}_{:d}'.format(args.papers, TEXT_WORDS))
+    if not os.path.isdir(os.path.join(workdir, 'data', 'json')):
+        shutil.rmtree(workdir, ignore_errors=True)
+        print('generating {:d} papers in {:}'.format(args.papers, workdir))
+        synthetic.generate(workdir, args.papers, seed=0, text_words=TEXT_WORDS)
+    times = run_stages(workdir, args.repeat)
+
+    baselines = json.load(open(BASELINES_PATH)) if os.path.isfile(BASELINES_PATH) else {}
+    baseline = baselines.get(str(args.papers))
+    regressions = []
+    print('stage               seconds   relative  baseline  change')
+    for stage, seconds in times.items():
+        relative = seconds / times['calibration']
+        line = '{:18s}  {:7.3f}  {:9.3f}'.format(stage, seconds, relative)
+        if baseline is not None and stage in baseline['relative'] and stage != 'calibration':
+            change = relative / baseline['relative'][stage] - 1.0
+            line += '  {:8.3f}  {:+6.1%}'.format(baseline['relative'][stage], change)
+            if change > args.tolerance:
+                regressions.append(stage)
+                line += '  REGRESSION'
+        print(line)
+
+    if args.save_baseline:
+        baselines[str(args.papers)] = {
+            'machine': '{:} {:}, python {:}'.format(platform.system(), platform.machine(), platform.python_version()),
+            'date': time.strftime('%Y-%m-%d'),
+            'seconds': {k: round(v, 4) for k, v in times.items()},
+            'relative': {k: round(v / times['calibration'], 4) for k, v in times.items()},
+        }
+        with open(BASELINES_PATH, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print('wrote the baselines to', BASELINES_PATH)
+    elif baseline is None:
+        print('no baselines for {:d} papers, store them with --save-baseline'.format(args.papers))
+    elif regressions:
+        print('regressions beyond {:.0%}: {:}'.format(args.tolerance, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
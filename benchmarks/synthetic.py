@@ -0,0 +1,151 @@
+"""
+Synthetic paper databases for the benchmarks, written like the real ones: one
+json shard per conference in data/json, as the fetchers write them, and the
+full texts in data/txt, as analyze.py reads them.
+
+The words follow a Zipf distribution mixed with per-topic vocabularies, so
+that the tfidf matrix and the neighbors look like those of real papers, and
+the lengths of the titles, abstracts and author lists, the conference mix and
+the growth of the conferences over the years are roughly realistic.
+"""
+
+import json
+import os
+from operator import itemgetter
+
+import numpy as np
+
+# conference id, sub id, is workshop, years, relative size
+CONFERENCES = [
+    ('CVPR', 'Main', False, range(2017, 2023), 10.0),
+    ('CVPR', 'DeepVision', True, range(2017, 2023), 0.4),
+    ('CVPR', 'WiCV', True, range(2018, 2023), 0.3),
+    ('ICCV', 'Main', False, range(2017, 2023, 2), 8.0),
+    ('ICCV', 'AIM', True, range(2017, 2023, 2), 0.5),
+    ('ECCV', 'Main', False, range(2018, 2023, 2), 8.0),
+    ('WACV', 'Main', False, range(2020, 2023), 2.0),
+    ('ACCV', 'Main', False, range(2020, 2021), 1.5),
+    ('NeurIPS', 'Main', False, range(2017, 2023), 12.0),
+    ('ICLR', 'Main', False, range(2018, 2023), 5.0),
+    ('AAAI', 'Main', False, range(2017, 2023), 9.0),
+]
+
+BASE_WORDS = (
+    'learning network deep neural image model training data method results performance object detection '
+    'segmentation semantic instance video temporal optical flow estimation depth stereo pose tracking '
+    'recognition classification representation features attention transformer convolutional graph '
+    'adversarial generative diffusion reconstruction scene point cloud 3d shape surface mesh rendering '
+    'radiance field camera calibration motion dataset benchmark supervised unsupervised self contrastive '
+    'reinforcement policy reward agent language vision multimodal text retrieval embedding metric loss '
+    'optimization gradient stochastic convex robust adversarial uncertainty bayesian inference sampling '
+    'kernel regression sparse low rank matrix tensor efficient pruning quantization distillation '
+    'architecture search domain adaptation generalization transfer few shot zero continual federated '
+    'privacy fairness explainable interpretable causal temporal action recognition face person '
+    're-identification crowd counting medical segmentation super resolution denoising deblurring '
+    'inpainting style transfer editing synthesis layout detection keypoint correspondence matching').split()
+SYLLABLES = 'ka ro mi te su na lo vi de pa ri zo ba ne tu ge mo fi la sen tor vex dal quin'.split()
+FIRST_NAMES = ('john jane wei li maria carlos yuki hiro anna peter sara kim jun ahmed fatima olga ivan '
+               'lucas emma noah mia chen yan raj priya omar lea tom eva').split()
+LAST_NAMES = ('smith wang zhang garcia tanaka mueller rossi kim lee brown morimitsu silva chen liu yang '
+              'huang zhao wu zhou xu sun ma zhu hu guo he lin patel singh kumar nguyen tran novak').split()
+
+
+def make_vocabulary(size, rng):
+    """ The technical words first (the most frequent), then made up words of 2 to 4 syllables. """
+    words = list(dict.fromkeys(BASE_WORDS))
+    seen = set(words)
+    while len(words) < size:
+        word = ''.join(rng.choice(SYLLABLES, rng.randint(2, 5)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def conference_mix():
+    """ The (conf id, sub id, is workshop) of the conferences and their probabilities. """
+    confs, weights = [], []
+    for name, sub_id, is_workshop, years, size in CONFERENCES:
+        for year in years:
+            confs.append((name + str(year), sub_id, is_workshop))
+            weights.append(size * (1.0 + 0.3 * (year - 2017)))  # the conferences grow every year
+    weights = np.array(weights)
+    return confs, weights / weights.sum()
+
+
+class WordSampler(object):
+    """ Samples the words of a paper: mostly from the vocabulary of its topic, the rest from the whole
+    vocabulary, both following a Zipf distribution. """
+    def __init__(self, vocabulary, num_topics, rng, topic_size=300, topic_share=0.6):
+        self.vocabulary = vocabulary
+        self.rng = rng
+        self.topic_share = topic_share
+        ranks = np.arange(1, len(vocabulary) + 1)
+        self.cdf = np.cumsum(1.0 / ranks)
+        self.cdf /= self.cdf[-1]
+        self.topic_cdf = np.cumsum(1.0 / np.arange(1, topic_size + 1))
+        self.topic_cdf /= self.topic_cdf[-1]
+        self.topics = [rng.choice(len(vocabulary), topic_size, replace=False) for _ in range(num_topics)]
+
+    def words(self, topic, n):
+        in_topic = self.rng.random_sample(n) < self.topic_share
+        ids = np.searchsorted(self.cdf, self.rng.random_sample(n))
+        ids[in_topic] = self.topics[topic][np.searchsorted(self.topic_cdf, self.rng.random_sample(in_topic.sum()))]
+        return itemgetter(*ids)(self.vocabulary) if n > 1 else tuple(self.vocabulary[i] for i in ids)
+
+
+def generate(root, num_papers, seed=0, text_words=1500, text_share=0.9, vocabulary_size=30000, num_topics=200):
+    """ Writes num_papers synthetic papers to root/data/json, and the full texts of text_share of them, with
+    text_words words each, to root/data/txt. The same arguments always give the same papers. """
+    rng = np.random.RandomState(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    sampler = WordSampler(vocabulary, num_topics, rng)
+    confs, conf_p = conference_mix()
+    num_authors = max(num_papers // 3, 10)
+    last_names = LAST_NAMES + make_vocabulary(len(BASE_WORDS) + num_authors // 20, rng)[len(BASE_WORDS):]
+    authors = ['{:} {:}'.format(rng.choice(FIRST_NAMES), rng.choice(last_names)).title() for _ in range(num_authors)]
+    author_cdf = np.cumsum(1.0 / np.arange(1, num_authors + 1) ** 0.8)  # a few authors write many papers
+    author_cdf /= author_cdf[-1]
+
+    shards = {}
+    pids = set()
+    txt_dirs = set()
+    for i, c in enumerate(rng.choice(len(confs), num_papers, p=conf_p)):
+        conf_id, sub_id, is_workshop = confs[c]
+        topic = rng.randint(num_topics)
+        title = ' '.join(sampler.words(topic, rng.randint(6, 16))).capitalize()
+        pid = (conf_id + '_' + sub_id + '_' + title.replace(' ', '')).lower()
+        while pid in pids:
+            title += ' ' + sampler.words(topic, 1)[0]
+            pid = (conf_id + '_' + sub_id + '_' + title.replace(' ', '')).lower()
+        pids.add(pid)
+        summary = ' '.join(sampler.words(topic, rng.randint(120, 300)))
+        paper_authors = list(dict.fromkeys(
+            authors[j] for j in np.searchsorted(author_cdf, rng.random_sample(rng.randint(1, 9)))))
+        basename = 'paper{:d}.pdf'.format(i)
+        url = 'https://papers.example.com/{:}/{:}/'.format(conf_id, sub_id)
+        p = {
+            'conf_id': conf_id, 'conf_sub_id': sub_id, 'is_workshop': is_workshop,
+            'conf_name': conf_id + ('_workshops' if is_workshop else ''),
+            'title': title, 'authors': paper_authors,
+            'page_url': url + 'paper{:d}.html'.format(i), 'pdf_url': url + basename,
+            'published': '{:}-{:02d}'.format(conf_id[-4:], rng.randint(1, 13)),
+            'summary': summary}
+        if rng.random_sample() < 0.2:
+            p['code_link'] = 'https://github.com/example/paper{:d}'.format(i)
+        shards.setdefault(conf_id + ('W' if is_workshop else ''), {})[pid] = p
+
+        if rng.random_sample() < text_share:
+            txt_dir = os.path.join(root, 'data', 'txt', conf_id, sub_id)
+            if txt_dir not in txt_dirs:
+                os.makedirs(txt_dir, exist_ok=True)
+                txt_dirs.add(txt_dir)
+            with open(os.path.join(txt_dir, basename + '.txt'), 'w') as f:
+                f.write(title + '\n' + summary + '\n' + ' '.join(sampler.words(topic, text_words)))
+
+    json_dir = os.path.join(root, 'data', 'json')
+    os.makedirs(json_dir, exist_ok=True)
+    for name, shard in shards.items():
+        with open(os.path.join(json_dir, name + '.json'), 'w') as f:
+            json.dump(shard, f)
+    return num_papers
@@ -0,0 +1,382 @@
+"""
+The bundle of the files read by the server, written by analyze.py and
+make_cache.py into a staging folder of Config.bundle_dir, and published by
+make_cache.py with a manifest. Each script writes its parts into a folder of
+its own run first, and moves them to the staging folder only once they are
+all written, so that a run that crashed halfway never gets published.
+
+Every part of the bundle is a folder (or file) of one kind, loaded on its
+first use by the server, mostly as memory-mapped arrays. The version of the
+bundle identifies the files listed in the manifest. Publishing renames the
+staging folder after the version and then replaces the manifest of
+Config.bundle_dir, which points to that folder, so the files of a published
+version never change: a server loading its parts lazily cannot mix two
+versions. The server tells when a new bundle was published from the manifest,
+and loads it in the background with a BundleWatcher.
+"""
+
+from collections import OrderedDict
+import datetime
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from paperstore import PaperStore
+from similarity import load_csr, NeighborTable, LSHIndex, TextVectorizer
+from utils import Config, open_atomic, artifact_generation
+
+MANIFEST_NAME = 'manifest.json'
+STAGING_NAME = 'staging'
+RUN_PREFIX = '.run-'
+FORMAT_VERSION = 2
+# number of published versions kept, a server may still be loading the parts of a previous one
+KEEP_VERSIONS = 3
+# the long lists and dicts of the 'arrays' parts are pickled in chunks of this many items, each unpickled
+# in one call that holds the GIL, so that loading a bundle in the background does not stall the requests
+PICKLE_CHUNK_ITEMS = 10000
+
+# the parts of the bundle, their paths in the bundle folder and their kinds
+PARTS = OrderedDict([
+    ('papers', ('papers', 'papers')),  # make_cache.py
+    ('conferences', ('conferences', 'arrays')),
+    ('search', ('search', 'arrays')),
+    ('authors', ('authors', 'arrays')),
+    ('suggest', ('suggest', 'arrays')),
+    ('meta', ('meta', 'arrays')),  # analyze.py
+    ('tfidf', ('tfidf', 'csr')),
+    ('neighbors', ('sim', 'neighbors')),
+    ('ann', ('ann', 'ann')),
+    ('vectorizer', ('vectorizer.json', 'vectorizer')),
+])
+
+
+def read_manifest(dirpath):
+    with open(os.path.join(dirpath, MANIFEST_NAME), 'r') as f:
+        return json.load(f)
+
+
+def staging_dir(bundle_dir=Config.bundle_dir):
+    """ The folder where the scripts write the next version of the bundle. It starts as a copy of the current
+    version made of hard links, so that each script only rewrites its own parts, which is safe because the
+    files are always replaced (see utils.open_atomic) instead of modified in place. """
+    path = os.path.join(bundle_dir, STAGING_NAME)
+    if os.path.isdir(path):
+        return path
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    if os.path.isfile(os.path.join(bundle_dir, MANIFEST_NAME)):
+        manifest = read_manifest(bundle_dir)
+        current_dir = os.path.join(bundle_dir, manifest.get('dir', ''))  # no dir before the versioned folders
+        for part in manifest['parts'].values():
+            for f in part['files']:
+                os.makedirs(os.path.dirname(os.path.join(tmp_path, f)), exist_ok=True)
+                try:
+                    os.link(os.path.join(current_dir, f), os.path.join(tmp_path, f))
+                except OSError:
+                    shutil.copy2(os.path.join(current_dir, f), os.path.join(tmp_path, f))
+    os.rename(tmp_path, path)
+    return path
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # running, as another user
+    return True
+
+
+def run_dir(bundle_dir=Config.bundle_dir):
+    """ The folder where this process writes its parts of the bundle, until commit_parts(). The folders left by
+    the runs that crashed are removed. """
+    path = os.path.join(bundle_dir, RUN_PREFIX + str(os.getpid()))
+    if not os.path.isdir(path):
+        os.makedirs(bundle_dir, exist_ok=True)
+        for d in os.listdir(bundle_dir):
+            if d.startswith(RUN_PREFIX) and d[len(RUN_PREFIX):].isdigit() and not is_running(int(d[len(RUN_PREFIX):])):
+                print('removing the parts of a crashed run', d)
+                shutil.rmtree(os.path.join(bundle_dir, d))
+        os.makedirs(path)
+    return path
+
+
+def part_path(name, bundle_dir=Config.bundle_dir):
+    """ Where this process writes a part of the next version of the bundle. """
+    return os.path.join(run_dir(bundle_dir), PARTS[name][0])
+
+
+def staged_part_path(name, bundle_dir=Config.bundle_dir):
+    """ Where a part of the next version of the bundle is read, once it was committed. """
+    return os.path.join(staging_dir(bundle_dir), PARTS[name][0])
+
+
+def commit_parts(bundle_dir=Config.bundle_dir):
+    """ Moves the parts written by this process to the staging folder, replacing the ones there. """
+    run = os.path.join(bundle_dir, RUN_PREFIX + str(os.getpid()))
+    if not os.path.isdir(run):
+        return
+    staging = staging_dir(bundle_dir)
+    for relpath in sorted(os.listdir(run)):
+        src, dst = os.path.join(run, relpath), os.path.join(staging, relpath)
+        if os.path.isdir(dst):
+            shutil.rmtree(dst + '.old', ignore_errors=True)
+            os.rename(dst, dst + '.old')
+            os.rename(src, dst)
+            shutil.rmtree(dst + '.old')
+        else:
+            os.replace(src, dst)
+    os.rmdir(run)
+
+
+def save_arrays(dirpath, values):
+    """ Writes a dict as a part of kind 'arrays': the numpy arrays and the sparse matrices as .npy files,
+    which are memory-mapped when loading, and the other values in one pickle file, followed by the chunks
+    of the long lists and dicts. """
+    os.makedirs(dirpath, exist_ok=True)
+    arrays = {}
+    objects = {'__sparse__': {}, '__chunked__': []}
+    chunks = []
+    for key, value in values.items():
+        if sp.issparse(value):
+            objects['__sparse__'][key] = (value.format, value.shape)
+            arrays.update({key + '.data': value.data, key + '.indices': value.indices, key + '.indptr': value.indptr})
+        elif isinstance(value, np.ndarray):
+            arrays[key] = value
+        elif type(value) in (list, dict) and len(value) > PICKLE_CHUNK_ITEMS:
+            items = list(value.items()) if isinstance(value, dict) else value
+            key_chunks = [items[i:i+PICKLE_CHUNK_ITEMS] for i in range(0, len(items), PICKLE_CHUNK_ITEMS)]
+            objects['__chunked__'].append((key, type(value).__name__, len(key_chunks)))
+            chunks.extend(key_chunks)
+        else:
+            objects[key] = value
+    for key, arr in arrays.items():
+        with open_atomic(os.path.join(dirpath, key + '.npy'), 'wb') as f:
+            np.save(f, arr)
+    with open_atomic(os.path.join(dirpath, 'objects.p'), 'wb') as f:
+        pickle.dump(objects, f, -1)
+        for chunk in chunks:
+            pickle.dump(chunk, f, -1)
+
+
+def load_arrays(dirpath, mmap_mode='r'):
+    with open(os.path.join(dirpath, 'objects.p'), 'rb') as f:
+        values = pickle.load(f)
+        for key, kind, num_chunks in values.pop('__chunked__', []):
+            value = {} if kind == 'dict' else []
+            for _ in range(num_chunks):
+                chunk = pickle.load(f)
+                if kind == 'dict':
+                    value.update(chunk)
+                else:
+                    value.extend(chunk)
+            values[key] = value
+    sparse = values.pop('__sparse__')
+    for filename in os.listdir(dirpath):
+        if filename.endswith('.npy') and filename.count('.') == 1:
+            values[filename[:-4]] = np.load(os.path.join(dirpath, filename), mmap_mode=mmap_mode)
+    for key, (fmt, shape) in sparse.items():
+        arrays = [np.load(os.path.join(dirpath, '{:}.{:}.npy'.format(key, a)), mmap_mode=mmap_mode)
+                  for a in ['data', 'indices', 'indptr']]
+        matrix_class = sp.csc_matrix if fmt == 'csc' else sp.csr_matrix
+        values[key] = matrix_class(tuple(arrays), shape=shape, copy=False)
+    return values
+
+
+LOADERS = {
+    'arrays': load_arrays,
+    'csr': load_csr,
+    'papers': PaperStore,
+    'neighbors': NeighborTable,
+    'ann': LSHIndex.load,
+    'vectorizer': TextVectorizer.load,
+}
+
+
+def part_files(path):
+    """ Returns the files of a part, relative to its path. """
+    if os.path.isfile(path):
+        return ['']
+    return sorted(f for f in os.listdir(path) if not f.startswith('.'))
+
+
+def write_manifest(bundle_dir=Config.bundle_dir):
+    """ Publishes the staging folder, with the parts written by this process: lists the parts of the bundle
+    with their files, gives the bundle a version identifying them, renames the folder after the version and
+    points the manifest of bundle_dir to it. The oldest versions are removed. """
+    commit_parts(bundle_dir)
+    staging = staging_dir(bundle_dir)
+    parts = OrderedDict()
+    all_files = []
+    for name, (relpath, kind) in PARTS.items():
+        path = os.path.join(staging, relpath)
+        if not os.path.exists(path):
+            raise FileNotFoundError('missing part {:} of the bundle, in {:}'.format(name, path))
+        files = [os.path.join(path, f) if f else path for f in part_files(path)]
+        parts[name] = {
+            'path': relpath, 'kind': kind,
+            'files': {os.path.relpath(f, staging): os.path.getsize(f) for f in files}}
+        all_files.extend(files)
+    version = artifact_generation(all_files)
+    manifest = {
+        'format': FORMAT_VERSION,
+        'version': version,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'dir': version,
+        'parts': parts,
+    }
+    with open_atomic(os.path.join(staging, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    if os.path.isdir(os.path.join(bundle_dir, version)):
+        shutil.rmtree(staging)  # the same files as a published version
+    else:
+        os.rename(staging, os.path.join(bundle_dir, version))
+    with open_atomic(os.path.join(bundle_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    remove_old_versions(bundle_dir, keep=[version])
+    return manifest
+
+
+def remove_old_versions(bundle_dir=Config.bundle_dir, keep=()):
+    """ Removes the published versions but the KEEP_VERSIONS newest ones and those in keep, and the parts
+    written directly in bundle_dir before the versioned folders. """
+    versions = [d for d in os.listdir(bundle_dir)
+                if d != STAGING_NAME and os.path.isfile(os.path.join(bundle_dir, d, MANIFEST_NAME))]
+    versions.sort(key=lambda d: os.path.getmtime(os.path.join(bundle_dir, d, MANIFEST_NAME)), reverse=True)
+    for d in versions[KEEP_VERSIONS:]:
+        if d not in keep:
+            print('removing bundle version', d)
+            shutil.rmtree(os.path.join(bundle_dir, d))
+    for relpath, _ in PARTS.values():
+        path = os.path.join(bundle_dir, relpath)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+
+class Bundle(object):
+    """ The parts of a bundle, each loaded on its first access with bundle[name], and the values derived
+    from them, computed on their first access with derived[name](bundle). """
+    def __init__(self, bundle_dir=Config.bundle_dir, derived=None):
+        self.manifest = read_manifest(bundle_dir)
+        if self.manifest['format'] != FORMAT_VERSION:
+            raise ValueError('unsupported bundle format {:}, run make_cache.py again'.format(self.manifest['format']))
+        self.bundle_dir = bundle_dir
+        self.version_dir = os.path.join(bundle_dir, self.manifest['dir'])
+        self.version = self.manifest['version']
+        self.derived = derived or {}
+        self.values = {}
+        self.load_seconds = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        try:
+            return self.values[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self.values:
+                t0 = time.time()
+                if name in self.manifest['parts']:
+                    part = self.manifest['parts'][name]
+                    if not self.part_matches(part):
+                        raise ValueError('part {:} of bundle {:} does not match its manifest'.format(name, self.version))
+                    value = LOADERS[part['kind']](os.path.join(self.version_dir, part['path']))
+                elif name in self.derived:
+                    value = self.derived[name](self)
+                else:
+                    raise KeyError(name)
+                self.values[name] = value
+                self.load_seconds[name] = time.time() - t0
+        return self.values[name]
+
+    def part_matches(self, part):
+        """ Whether the files of a part still have the sizes listed in the manifest. """
+        try:
+            return all(os.path.getsize(os.path.join(self.version_dir, f)) == size for f, size in part['files'].items())
+        except OSError:
+            return False
+
+    def load_all(self):
+        for name in list(self.manifest['parts']) + list(self.derived):
+            self[name]
+
+    def load_times(self):
+        """ A copy of the loading times of the parts loaded so far, which other threads may be adding to. """
+        with self._lock:
+            return OrderedDict(self.load_seconds)
+
+    def report(self):
+        """ The version of the bundle and what was loaded from it so far, with the loading times. """
+        parts = self.manifest['parts']
+        load_seconds = self.load_times()
+        return {
+            'version': self.version,
+            'created': self.manifest['created'],
+            'loaded': [
+                {'name': name, 'seconds': round(seconds, 6),
+                 'bytes': sum(parts[name]['files'].values()) if name in parts else None}
+                for name, seconds in load_seconds.items()],
+            'not_loaded': [name for name in list(parts) + list(self.derived) if name not in load_seconds],
+        }
+
+
+def manifest_stamp(bundle_dir=Config.bundle_dir):
+    st = os.stat(os.path.join(bundle_dir, MANIFEST_NAME))
+    return st.st_mtime_ns, st.st_size
+
+
+class BundleWatcher(object):
+    """ Notices when a new manifest is written, at most every interval seconds, and then loads the new
+    bundle completely in a background thread before handing it to on_load(bundle). Until then, and if
+    the new bundle fails to load, the current bundle keeps being used. """
+    def __init__(self, bundle, on_load, interval=10.0):
+        self.bundle_dir = bundle.bundle_dir
+        self.derived = bundle.derived
+        self.version = bundle.version
+        self.on_load = on_load
+        self.interval = interval
+        self.stamp = manifest_stamp(self.bundle_dir)
+        self.checked = time.time()
+        self.loading = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        now = time.time()
+        with self._lock:
+            if self.loading or now - self.checked < self.interval:
+                return
+            self.checked = now
+            try:
+                stamp = manifest_stamp(self.bundle_dir)
+            except OSError:
+                return
+            if stamp == self.stamp:
+                return
+            self.stamp = stamp
+            self.loading = True
+        threading.Thread(target=self._load, daemon=True).start()
+
+    def _load(self):
+        try:
+            t0 = time.time()
+            bundle = Bundle(self.bundle_dir, derived=self.derived)
+            if bundle.version != self.version:
+                bundle.load_all()
+                print('loaded bundle version {:} in {:.3f}s'.format(bundle.version, time.time() - t0))
+                self.version = bundle.version
+                self.on_load(bundle)
+        except Exception as e:
+            print('failed to load the new bundle, keeping version {:}: {:}'.format(self.version, e))
+        finally:
+            with self._lock:
+                self.loading = False
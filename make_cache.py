@@ -3,7 +3,8 @@ computes various cache things on top of db.py so that the server
 (running from serve.py) can start up and serve faster when restarted.
 
 this script should be run whenever db.p is updated, and 
-creates db2.p, which can be read by the server.
+creates db2.p, and the parts of the bundle read by the server (see
+bundle.py) that are not written by analyze.py.
 """
 
 import time
@@ -11,9 +12,15 @@ import pickle
 import dateutil.parser
 import string
 
-from utils import safe_pickle_dump, Config, load_json_db
+import numpy as np
+import scipy.sparse as sp
 
-CACHE = {}
+from bundle import part_path, save_arrays, write_manifest
+from paperstore import PaperStore
+from utils import safe_pickle_dump, Config, load_json_db, char_trigrams, htmlsafe_json_dumps, tokenize, make_search_dict
+
+# the parts of the bundle written by this script, see bundle.py
+CACHE = {'conferences': {}, 'search': {}, 'authors': {}, 'suggest': {}}
 IGNORE_WORD = [
     'about', 'am', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'do', 'does', 'for', 'from', 'he', 'in', 'is', 'it', 'me', 'my', 'of', 'on', 'she', 'so', 'the', 'they', 'to', 'under', 'using', 'via', 'we', 'with', 'without', 'you'
 ]
@@ -70,6 +77,28 @@ for pid,p in db.items():
     p['bib_authors'] = bib_authors
     p['bib_booktitle'] = format_booktitle(p['conf_id'], p['conf_name'])
 
+print('serializing the paper records sent to the client...')
+paper_json = {}
+for pid,p in db.items():
+    timestruct = dateutil.parser.parse(p['published'])
+    paper_json[pid] = htmlsafe_json_dumps({
+        'title': p['title'],
+        'pid': pid,
+        'authors': p['authors'],
+        'link': p['page_url'],
+        'pdf_link': p['pdf_url'],
+        'conf_name': p['conf_name'],
+        'composed_conf_id': p['composed_conf_id'],
+        'bib_id': p['bib_id'],
+        'bib_authors': p['bib_authors'],
+        'bib_booktitle': p['bib_booktitle'],
+        'year': p['year'],
+        'code_link': p.get('code_link', ''),
+        'abstract': p['summary'],
+        # render time information nicely
+        'published_time': '%s/%s/%s' % (timestruct.month, timestruct.day, timestruct.year),
+    })
+
 print('computing min/max time for all papers...')
 tts = [time.mktime(dateutil.parser.parse(p['published']).timetuple()) for pid,p in db.items()]
 ttmin = min(tts)*1.0
@@ -80,58 +109,130 @@ for pid,p in db.items():
 
 print('precomputing conference data...')
 composed_conference_ids = set([(p['conf_id'], dateutil.parser.parse(p['published'])) for pid,p in db.items()])
-CACHE['conference_sorted_pids'] = {
+conference_sorted_pids = {
     cid[0]: [pid for pid,p in db.items() if p['conf_id'] == cid[0]] for cid in composed_conference_ids
 }
 composed_conference_ids = sorted(list(composed_conference_ids), key=lambda x: x[1], reverse=True)
 most_recent_conference_idx = composed_conference_ids[0][0]
 if most_recent_conference_idx.endswith('W'):
     most_recent_conference_idx = most_recent_conference_idx[:-1]
-CACHE['most_recent_conference_name'] = most_recent_conference_idx[:-4]
-CACHE['newest_conference_year'] = composed_conference_ids[0][1].strftime('%Y')
-CACHE['oldest_conference_year'] = composed_conference_ids[-1][1].strftime('%Y')
-
-# some utilities for creating a search index for faster search
-punc = "'!\"#$%&\'()*+,./:;<=>?@[\\]^_`{|}~'" # removed hyphen from string.punctuation
-trans_table = {ord(c): None for c in punc}
-def makedict(s, forceidf=None, scale=1.0):
-    words = set(s.lower().translate(trans_table).strip().split())
-    idfd = {}
-    for w in words: # todo: if we're using bigrams in vocab then this won't search over them
-        if forceidf is None:
-            if w in vocab:
-                # we have idf for this
-                idfval = idf[vocab[w]]*scale
-            else:
-                idfval = 1.0*scale # assume idf 1.0 (low)
-        else:
-            idfval = forceidf
-        idfd[w] = idfval
-    return idfd
-
-def merge_dicts(dlist):
-    m = {}
-    for d in dlist:
-        for k, v in d.items():
-            m[k] = m.get(k, 0) + v
-    return m
+CACHE['conferences']['most_recent_conference_name'] = most_recent_conference_idx[:-4]
+CACHE['conferences']['newest_conference_year'] = composed_conference_ids[0][1].strftime('%Y')
+CACHE['conferences']['oldest_conference_year'] = composed_conference_ids[-1][1].strftime('%Y')
 
 print('building an index for faster search...')
-search_dict = {}
+search_dict = make_search_dict(db, vocab, idf)
+
+print('converting the index into a sparse paper x term matrix...')
+# papers are the rows of the matrix, in the db order so that ties in the search ranking
+# are broken in the same way as when iterating over the db
+search_pids = list(db)
+search_terms = {}
+rows, cols, vals = [], [], []
+for i, pid in enumerate(search_pids):
+    for w, v in search_dict[pid].items():
+        rows.append(i)
+        cols.append(search_terms.setdefault(w, len(search_terms)))
+        vals.append(v)
+search_matrix = sp.csr_matrix((vals, (rows, cols)), shape=(len(search_pids), len(search_terms)), dtype=np.float64)
+CACHE['search']['tscores'] = np.array([db[pid]['tscore'] for pid in search_pids], dtype=np.float64)
+CACHE['search']['terms'] = search_terms  # term -> column of search_matrix
+# stored column-major, so that a query only reads the postings of its own terms
+search_matrix = search_matrix.tocsc()
+search_matrix.sort_indices()
+CACHE['search']['matrix'] = search_matrix
+
+print('building a bigram index for phrase search...')
+# every pair of adjacent words in the title or abstract of a paper, identified by a single integer
+# computed from the columns of both words in search_matrix
+n_terms = len(search_terms)
+bigram_keys, bigram_pids = [], []
+for i, pid in enumerate(search_pids):
+    keys = set()
+    for s in (db[pid]['title'], db[pid]['summary']):
+        tids = [search_terms[w] for w in tokenize(s)]
+        keys.update(a*n_terms + b for a, b in zip(tids[:-1], tids[1:]))
+    bigram_keys.extend(keys)
+    bigram_pids.extend([i]*len(keys))
+bigram_keys = np.array(bigram_keys, dtype=np.int64)
+bigram_pids = np.array(bigram_pids, dtype=np.int32)
+order = np.lexsort((bigram_pids, bigram_keys))
+bigram_keys, bigram_starts = np.unique(bigram_keys[order], return_index=True)
+CACHE['search']['bigram_keys'] = bigram_keys  # sorted, so they can be found with a binary search
+CACHE['search']['bigram_indptr'] = np.append(bigram_starts, len(order)).astype(np.int64)
+CACHE['search']['bigram_postings'] = bigram_pids[order]  # sorted paper indices for each bigram
+# the bigrams from the tfidf vocabulary give an extra score to the papers that contain them
+bigram_idf = {}
+for w, j in vocab.items():
+    words = w.split(' ')
+    if len(words) == 2 and words[0] in search_terms and words[1] in search_terms:
+        bigram_idf[search_terms[words[0]]*n_terms + search_terms[words[1]]] = float(idf[j])
+CACHE['search']['bigram_idf'] = bigram_idf
+
+# the papers of each conference, as indices in search_pids in the same way as the authors below
+search_rows = {pid: i for i, pid in enumerate(search_pids)}
+conference_ids = sorted(conference_sorted_pids)
+CACHE['conferences']['ids'] = {cid: i for i, cid in enumerate(conference_ids)}  # conference id -> position in indptr
+CACHE['conferences']['indptr'] = np.cumsum([0] + [len(conference_sorted_pids[c]) for c in conference_ids], dtype=np.int64)
+CACHE['conferences']['papers'] = np.array([search_rows[pid] for c in conference_ids for pid in conference_sorted_pids[c]], dtype=np.int32)
+
+print('building the author index...')
+# every distinct author name gets an id, with the indices (in search_pids) of its papers from the newest to the oldest
+author_ids = {}
+author_papers = []
+by_date = sorted(range(len(search_pids)), key=lambda i: db[search_pids[i]]['published'], reverse=True)
+for i in by_date:
+    for a in set(db[search_pids[i]]['authors']):
+        aid = author_ids.setdefault(' '.join(a.lower().split()), len(author_ids))
+        if aid == len(author_papers):
+            author_papers.append([])
+        author_papers[aid].append(i)
+CACHE['authors']['ids'] = author_ids  # normalized name -> position in author_indptr
+CACHE['authors']['indptr'] = np.cumsum([0] + [len(a) for a in author_papers], dtype=np.int64)
+CACHE['authors']['papers'] = np.array([i for a in author_papers for i in a], dtype=np.int32)
+
+print('building a character trigram index over the search terms...')
+# used to find the terms closest to a misspelled query word, terms are the columns of search_matrix
+trigram_postings = {}
+for w, tid in search_terms.items():
+    for g in char_trigrams(w):
+        trigram_postings.setdefault(g, []).append(tid)
+CACHE['search']['trigram_rows'] = {g: i for i, g in enumerate(trigram_postings)}  # trigram -> position in trigram_indptr
+CACHE['search']['trigram_indptr'] = np.cumsum([0] + [len(t) for t in trigram_postings.values()], dtype=np.int64)
+CACHE['search']['trigram_postings'] = np.array([tid for t in trigram_postings.values() for tid in t], dtype=np.int32)
+
+print('building a prefix index for search suggestions...')
+# every suggestion is found by its lowercase key, authors also by their last names so that
+# "smi" suggests "John Smith", and suggestions for the same prefix are ranked by number of papers
+suggestions = {}
+def add_suggestion(key, text, kind):
+    if (key, text) not in suggestions:
+        suggestions[(key, text)] = [kind, 0]
+    suggestions[(key, text)][1] += 1
 for pid,p in db.items():
-    dict_title = makedict(p['title'], forceidf=5, scale=3)
-    dict_authors = makedict(' '.join(x for x in p['authors']), forceidf=5)
-    dict_categories = {p['composed_conf_id'].lower(): 5}
-    dict_conf_name = makedict(p['conf_name'], forceidf=5, scale=3)
-    if 'and' in dict_authors: 
-        # special case for "and" handling in authors list
-        del dict_authors['and']
-    dict_summary = makedict(p['summary'])
-    search_dict[pid] = merge_dicts([dict_title, dict_authors, dict_categories, dict_summary, dict_conf_name])
-CACHE['search_dict'] = search_dict
+    for w in set(tokenize(p['title'])):
+        if len(w) > 1 and w not in IGNORE_WORD:
+            add_suggestion(w, w, 'term')
+    for a in set(p['authors']):
+        names = a.lower().split()
+        for i in range(len(names)):
+            add_suggestion(' '.join(names[i:]), a, 'author')
+    add_suggestion(p['composed_conf_id'].lower(), p['composed_conf_id'], 'conference')
+suggest_keys = sorted(suggestions)
+CACHE['suggest']['keys'] = [k for k, _ in suggest_keys]  # sorted, for a binary search over the prefixes
+CACHE['suggest']['texts'] = [t for _, t in suggest_keys]
+CACHE['suggest']['kinds'] = [suggestions[k][0] for k in suggest_keys]
+CACHE['suggest']['counts'] = np.array([suggestions[k][1] for k in suggest_keys], dtype=np.int32)
 
 # save the cache
-print('writing', Config.serve_cache_path)
-safe_pickle_dump(CACHE, Config.serve_cache_path)
 print('writing', Config.db_serve_path)
 safe_pickle_dump(db, Config.db_serve_path)
+for name, values in CACHE.items():
+    print('writing', part_path(name))
+    save_arrays(part_path(name), values)
+# the papers in the rows of the search matrix, with their serialized records
+print('writing', part_path('papers'))
+PaperStore.save(part_path('papers'), [dict(db[pid], json=paper_json[pid]) for pid in search_pids])
+# and last the manifest, with the parts written by analyze.py
+manifest = write_manifest()
+print('wrote the manifest of bundle version', manifest['version'])
@@ -0,0 +1,144 @@
+"""
+Lightweight metrics of the server (request counts, latency and size histograms),
+rendered in the Prometheus text format by serve.py at /metrics.
+
+An observation costs a bisection and a few additions under a lock, so the
+metrics can stay on in production. Each server process keeps its own values.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# in number of papers
+SIZE_BUCKETS = (0, 1, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000, 50000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{:}="{:}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """ A value that only goes up, by label values. """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{:}{:} {:}'.format(self.name, _format_labels(self.labels, k), _format_value(v)) for k, v in values]
+
+
+class Gauge(object):
+    """ Values read when the metrics are rendered, fn() returns a dict of label values -> value. The
+    values kept elsewhere that only go up (e.g. the hits of a cache) are rendered with kind='counter'. """
+    def __init__(self, name, help, labels, fn, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+        self.kind = kind
+
+    def collect(self):
+        return ['{:}{:} {:}'.format(self.name, _format_labels(self.labels, k), _format_value(v))
+                for k, v in sorted(self.fn().items())]
+
+
+class Histogram(object):
+    """ Counts of the observed values in buckets, with their sum, by label values. """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [count of each bucket and of +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *label_values)
+
+    def collect(self):
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+        lines = []
+        for label_values, counts in series:
+            total = 0
+            for le, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                lines.append('{:}_bucket{:} {:d}'.format(
+                    self.name, _format_labels(self.labels, label_values, [('le', _format_value(le))]), total))
+            labels = _format_labels(self.labels, label_values)
+            lines.append('{:}_sum{:} {:}'.format(self.name, labels, repr(float(counts[-1]))))
+            lines.append('{:}_count{:} {:d}'.format(self.name, labels, total))
+        return lines
+
+
+class Registry(object):
+    """ The metrics of a process, all rendered together. """
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels, fn, kind='gauge'):
+        return self._add(Gauge(name, help, labels, fn, kind))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {:} {:}'.format(metric.name, metric.help))
+            lines.append('# TYPE {:} {:}'.format(metric.name, metric.kind))
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,178 @@
+"""
+A columnar, read-only store of the paper metadata used by the server.
+
+The text fields are concatenated into UTF-8 heaps indexed by offset arrays,
+and the other fields are fixed-width arrays, all saved as .npy files that
+the server memory-maps. The server processes then share the pages of the
+store through the page cache, instead of each holding (and touching, with
+the reference counting) its own unpickled dict of papers.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from utils import open_atomic
+
+TEXT_FIELDS = ['title', 'authors', 'summary', 'json']
+AUTHORS_SEPARATOR = '\x1f'  # the names of the authors may contain newlines
+
+
+def encode_pid(pid):
+    """ The key of a pid in the store. A pid from a request may hold lone surrogates (JSON allows them), which
+    are kept as they are: such a key is never the one of a stored pid, which is valid UTF-8. """
+    return pid.encode('utf-8', 'surrogatepass')
+
+
+def _save_array(dirpath, name, arr):
+    with open_atomic(os.path.join(dirpath, name + '.npy'), 'wb') as f:
+        np.save(f, arr)
+
+
+class Paper(object):
+    """ A paper of a PaperStore, read like the dicts of the db. """
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, key):
+        store, row = self.store, self.row
+        if key == 'pid':
+            return store.pid(row)
+        elif key == 'authors':
+            return store.text('authors', row).split(AUTHORS_SEPARATOR)
+        elif key in TEXT_FIELDS:
+            return store.text(key, row)
+        elif key == 'conf_id':
+            return store.conf_ids[store.conf[row]]
+        elif key == 'year':
+            return str(store.year[row])
+        elif key == 'tscore':
+            return float(store.tscore[row])
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class PaperList(object):
+    """ A sequence of papers of a PaperStore, given by their rows, only read when accessed. """
+    __slots__ = ('store', 'rows')
+
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [Paper(self.store, int(row)) for row in self.rows[i]]
+        return Paper(self.store, int(self.rows[i]))
+
+    def __iter__(self):
+        return (Paper(self.store, int(row)) for row in self.rows)
+
+
+class PaperStore(object):
+    """ The papers written by make_cache.py, in the order of the rows of the search matrix. """
+    def __init__(self, dirpath, mmap_mode='r'):
+        def load(name):
+            return np.load(os.path.join(dirpath, name + '.npy'), mmap_mode=mmap_mode)
+        self.pids = load('pids')  # fixed-width bytes, by row
+        self.sorted_pids = load('sorted_pids')  # the same, sorted for the lookups by pid
+        self.sorted_rows = load('sorted_rows')
+        self.heaps = {name: load(name + '_heap') for name in TEXT_FIELDS}
+        self.offsets = {name: load(name + '_offsets') for name in TEXT_FIELDS}
+        self.year = load('year')
+        self.conf = load('conf')
+        self.tscore = load('tscore')
+        with open(os.path.join(dirpath, 'conf_ids.json'), 'r') as f:
+            self.conf_ids = json.load(f)
+
+    @staticmethod
+    def save(dirpath, papers):
+        """ Writes the papers (dicts with a pid, the TEXT_FIELDS, conf_id, year and tscore) to dirpath. """
+        os.makedirs(dirpath, exist_ok=True)
+        pids = np.array([p['pid'].encode('utf-8') for p in papers])
+        order = np.argsort(pids, kind='stable')
+        _save_array(dirpath, 'pids', pids)
+        _save_array(dirpath, 'sorted_pids', pids[order])
+        _save_array(dirpath, 'sorted_rows', order.astype(np.int32))
+        for name in TEXT_FIELDS:
+            values = [AUTHORS_SEPARATOR.join(p[name]) if name == 'authors' else p[name] for p in papers]
+            encoded = [v.encode('utf-8') for v in values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(b) for b in encoded], out=offsets[1:])
+            _save_array(dirpath, name + '_heap', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+            _save_array(dirpath, name + '_offsets', offsets)
+        conf_ids = sorted(set(p['conf_id'] for p in papers))
+        conf_index = {c: i for i, c in enumerate(conf_ids)}
+        _save_array(dirpath, 'year', np.array([int(p['year']) for p in papers], dtype=np.int16))
+        _save_array(dirpath, 'conf', np.array([conf_index[p['conf_id']] for p in papers], dtype=np.int16))
+        _save_array(dirpath, 'tscore', np.array([p['tscore'] for p in papers], dtype=np.float64))
+        with open_atomic(os.path.join(dirpath, 'conf_ids.json'), 'w') as f:
+            json.dump(conf_ids, f)
+
+    def __len__(self):
+        return len(self.pids)
+
+    def row(self, pid):
+        """ Returns the row of a pid, or -1 if it is not in the store. """
+        key = encode_pid(pid)
+        i = np.searchsorted(self.sorted_pids, key)
+        if i < len(self.sorted_pids) and self.sorted_pids[i] == key:
+            return int(self.sorted_rows[i])
+        return -1
+
+    def rows(self, pids, block=4096):
+        """ Returns the rows of a list of pids (or an array of encoded pids) as an array, with -1 for the
+        ones not in the store. The pids are looked up in blocks, since numpy holds the GIL while comparing
+        strings: all the pids of a new bundle at once would stall the other threads. """
+        if len(pids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        # the keys keep their own width, a longer pid must not be truncated into a stored one
+        keys = pids if isinstance(pids, np.ndarray) else np.array([encode_pid(pid) for pid in pids])
+        rows = np.empty(len(keys), dtype=np.int64)
+        for start in range(0, len(keys), block):
+            k = keys[start:start+block]
+            i = np.minimum(np.searchsorted(self.sorted_pids, k), len(self.sorted_pids) - 1)
+            found = np.asarray(self.sorted_pids[i]) == k
+            rows[start:start+block] = np.where(found, self.sorted_rows[i], -1)
+        return rows
+
+    def __contains__(self, pid):
+        return self.row(pid) >= 0
+
+    def __getitem__(self, pid):
+        row = self.row(pid)
+        if row < 0:
+            raise KeyError(pid)
+        return Paper(self, row)
+
+    def __iter__(self):
+        return (self.pid(row) for row in range(len(self)))
+
+    def paper(self, row):
+        return Paper(self, row)
+
+    def papers(self, rows):
+        return PaperList(self, rows)
+
+    def pid(self, row):
+        return self.pids[row].decode('utf-8')
+
+    def text(self, name, row):
+        offsets = self.offsets[name]
+        return self.heaps[name][offsets[row]:offsets[row+1]].tobytes().decode('utf-8')
+
+    def json(self, row):
+        """ The JSON record of the paper sent to the client, serialized by make_cache.py. """
+        return self.text('json', row)
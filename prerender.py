@@ -0,0 +1,43 @@
+"""
+Renders all the conference listing pages (every conference, year and type
+served by the / route) to static HTML files, plus a gzip-compressed copy of
+each one, so that serve.py (or a front proxy) can send them straight from
+the disk.
+
+this script should be run after make_cache.py. The pages are written to a
+folder named after the version of the bundle, and serve.py only uses the
+folder of the version it has loaded.
+"""
+
+import gzip
+import os
+import shutil
+
+from serve import app, BUNDLE, render_conference_page, prerendered_page_name
+from utils import Config, open_atomic
+
+out_dir = os.path.join(Config.prerender_dir, BUNDLE.version)
+os.makedirs(out_dir, exist_ok=True)
+
+num_pages = 0
+for conf_str, years in BUNDLE['conferences_dict'].items():
+    for year_str, types in years.items():
+        for type_str in types:
+            with app.test_request_context('/', query_string={'conf': conf_str, 'year': year_str, 'type': type_str}):
+                body = render_conference_page(conf_str, year_str, type_str).encode('utf-8')
+            page_path = os.path.join(out_dir, prerendered_page_name(conf_str, year_str, type_str))
+            with open_atomic(page_path, 'wb') as f:
+                f.write(body)
+            with open_atomic(page_path + '.gz', 'wb') as f:
+                f.write(gzip.compress(body))
+            # readable by a front proxy running as another user
+            os.chmod(page_path, 0o644)
+            os.chmod(page_path + '.gz', 0o644)
+            num_pages += 1
+print('rendered %d pages into %s' % (num_pages, out_dir))
+
+# pages of older versions of the bundle are not served anymore
+for d in os.listdir(Config.prerender_dir):
+    if d != BUNDLE.version and os.path.isdir(os.path.join(Config.prerender_dir, d)):
+        print('removing old pages', d)
+        shutil.rmtree(os.path.join(Config.prerender_dir, d))
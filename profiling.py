@@ -0,0 +1,140 @@
+"""
+Profiles of the requests answered by serve.py, to find where the time goes
+under real traffic without redeploying.
+
+A request chosen up front (one in every N requests, or a request with a
+signed header) is profiled with cProfile. Otherwise, when a latency threshold
+is set, the stack of the thread running the request is sampled every few
+milliseconds, and the samples are kept only if the request turns out slower
+than the threshold. Each profile is written to a folder that only keeps the
+newest ones, next to a JSON file describing the request.
+"""
+
+from collections import Counter
+import cProfile
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from utils import open_atomic
+
+
+def fold_stack(frame):
+    """ The stack of a frame in the folded format of the flame graph tools, from the outermost call. """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{:} ({:}:{:d})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler(object):
+    """ Samples the stacks of the registered threads from a background thread, every interval seconds. """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._stacks = {}  # thread id -> counts of the folded stacks
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id):
+        with self._lock:
+            self._stacks[thread_id] = Counter()
+            self._active.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id):
+        """ Returns the counts of the stacks sampled from the thread since start(thread_id). """
+        with self._lock:
+            stacks = self._stacks.pop(thread_id, Counter())
+            if not self._stacks:
+                self._active.clear()
+        return stacks
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in self._stacks.items():
+                    if thread_id in frames:
+                        stacks[fold_stack(frames[thread_id])] += 1
+
+
+class RequestProfiler(object):
+    """ Chooses the requests to profile, and writes their profiles to profile_dir.
+
+    One in every one_in requests (never if 0), and the requests started with force=True, are
+    profiled with cProfile, one at a time. If slow_seconds is set, the other requests are
+    sampled, and the ones slower than slow_seconds are written as folded stacks.
+    """
+    def __init__(self, profile_dir, slow_seconds=None, one_in=0, max_files=200, sample_interval=0.005):
+        self.profile_dir = profile_dir
+        self.slow_seconds = slow_seconds
+        self.one_in = one_in
+        self.max_files = max_files
+        self.sampler = StackSampler(sample_interval)
+        self._count = itertools.count(1)
+        self._cprofile_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def start(self, force=False):
+        """ Starts profiling the request running in this thread if it is chosen, and returns the
+        state to pass to stop(), or None. """
+        n = next(self._count)
+        if (force or (self.one_in > 0 and n % self.one_in == 0)) and self._cprofile_lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+            profile.enable()
+            return 'cprofile', profile, time.perf_counter()
+        if self.slow_seconds is not None:
+            self.sampler.start(threading.get_ident())
+            return 'samples', threading.get_ident(), time.perf_counter()
+        return None
+
+    def stop(self, state, info):
+        """ Stops profiling a request, and writes its profile with the description of the request in info
+        (route, query, etc.) if it was profiled with cProfile or was slow. """
+        kind, profile, t0 = state
+        seconds = time.perf_counter() - t0
+        if kind == 'cprofile':
+            profile.disable()
+            self._cprofile_lock.release()
+            self.write(info, seconds, '.prof', profile.dump_stats)
+        else:
+            stacks = self.sampler.stop(profile)
+            if seconds >= self.slow_seconds and stacks:
+                def dump(path):
+                    with open_atomic(path, 'w') as f:
+                        f.writelines('{:} {:d}\n'.format(stack, count) for stack, count in stacks.most_common())
+                self.write(info, seconds, '.folded', dump)
+
+    def write(self, info, seconds, extension, dump_fn):
+        now = time.time()
+        name = '{:}_{:06d}_{:}_{:d}ms'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), int(now * 1e6) % 1000000, info.get('route'), int(1000 * seconds))
+        info = dict(info, seconds=round(seconds, 6), profile=name + extension, pid=os.getpid())
+        with self._write_lock:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            dump_fn(os.path.join(self.profile_dir, name + extension))
+            with open_atomic(os.path.join(self.profile_dir, name + '.json'), 'w') as f:
+                json.dump(info, f, indent=1)
+            self.rotate()
+
+    def rotate(self):
+        """ Removes the oldest profiles, keeping the newest max_files. """
+        files = os.listdir(self.profile_dir)
+        names = sorted(f[:-5] for f in files if f.endswith('.json'))
+        old = set(names[:max(len(names) - self.max_files, 0)])
+        for f in files:
+            if f.rsplit('.', 1)[0] in old:
+                try:
+                    os.remove(os.path.join(self.profile_dir, f))
+                except OSError:
+                    pass  # removed by another process
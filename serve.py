@@ -1,13 +1,25 @@
+import time
+STARTUP_TIME = time.time() # before the other imports, which are part of the startup time
+
 import os
-import pickle
 import argparse
-import dateutil.parser
-
-from flask import Flask, request, url_for, redirect, render_template
+import bisect
+import gzip
+import hashlib
+import json
+import numpy as np
+import scipy.sparse as sp
+
+from flask import Flask, request, url_for, redirect, render_template, jsonify, abort, send_file, g, has_request_context
 from flask_limiter.util import get_remote_address
 from flask_limiter import Limiter
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 
-from utils import isvalidid, Config
+from bundle import Bundle, BundleWatcher
+from metrics import Registry, SIZE_BUCKETS
+from profiling import RequestProfiler
+from similarity import argsort_top_k, similar_rows, similar_to_rows
+from utils import isvalidid, Config, LRUCache, char_trigrams, edit_distance
 
 # various globals
 # -----------------------------------------------------------------------------
@@ -21,75 +33,321 @@ app = Flask(__name__)
 app.config.from_object(__name__)
 limiter = Limiter(app, key_func=get_remote_address, default_limits=["100000 per hour", "20000 per minute"])
 
+# number of papers sent to the client in one page, the following pages are fetched from the /api endpoints
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 200
+# number of similar papers found for the papers that have no precomputed neighbors, as in analyze.py
+SIMILAR_TOP_K = 500
+# maximum number of papers in a "more like these" query
+MAX_SET_SIZE = 200
+# maximum number of characters of a pasted abstract in a free-text similarity query
+MAX_TEXT_LENGTH = 20000
+
+# results of recent search and similarity queries, valid for the currently loaded files
+QUERY_CACHE = LRUCache(maxsize=4096)
+# rendered (and compressed) conference listing pages, also valid for the currently loaded files
+PAGE_CACHE = LRUCache(maxsize=1024)
+# static files are requested with a hash of their content, so the browsers can keep them for a long time
+STATIC_HASHES = {}
+
+# how often the requests check whether make_cache.py wrote a new bundle, in seconds
+RELOAD_CHECK_SECONDS = 10
+
+# metrics of this process, rendered at /metrics
+METRICS = Registry(prefix='similarpapers_')
+REQUEST_SECONDS = METRICS.histogram('request_seconds', 'Time to answer the requests, by route.', ['route'])
+REQUESTS = METRICS.counter('requests_total', 'Requests answered, by route and status.', ['route', 'status'])
+FUNCTION_SECONDS = METRICS.histogram('function_seconds', 'Time spent in the search, similarity and encoding functions.', ['function'])
+RESULTS = METRICS.histogram('results', 'Number of papers found by the search and similarity queries.', ['function'], SIZE_BUCKETS)
+RENDER_SECONDS = METRICS.histogram('render_seconds', 'Time to render the templates.', ['template'])
+METRICS.gauge('bundle_load_seconds', 'Time to load each part of the bundle in use.', ['part'],
+              lambda: {(name,): seconds for name, seconds in current_bundle().load_times().items()})
+METRICS.gauge('bundle_info', 'The version of the bundle in use.', ['version'], lambda: {(current_bundle().version,): 1})
+METRICS.gauge('startup_seconds', 'Time this process took to start.', [], lambda: {(): STARTUP_SECONDS})
+for stat in ['hits', 'misses', 'evictions']:
+    METRICS.gauge('cache_{:}_total'.format(stat), 'Cache {:}, by cache.'.format(stat), ['cache'],
+                  lambda stat=stat: {('queries',): QUERY_CACHE.stats()[stat], ('pages',): PAGE_CACHE.stats()[stat]},
+                  kind='counter')
+
+# profiles of the requests, see profiling.py. Besides the ones chosen in Config, the requests with a PROFILE_HEADER
+# signed with the secret key (see --profile-token) are profiled, only if the key was set in secret_key.txt
+PROFILER = RequestProfiler(Config.profile_dir, Config.profile_slow_seconds, Config.profile_one_in, Config.profile_max_files)
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN_MAX_AGE = 24 * 3600
+PROFILE_SIGNER = URLSafeTimedSerializer(SECRET_KEY, salt='profile') if os.path.isfile('secret_key.txt') else None
+
 # -----------------------------------------------------------------------------
 # search/sort functionality
 # -----------------------------------------------------------------------------
 
 
-def papers_search(qraw):
-    qparts = qraw.lower().strip().split() # split by spaces
-    # use reverse index and accumulate scores
-    scores = []
-    for pid, p in db.items():
-        score = sum(SEARCH_DICT[pid].get(q,0) for q in qparts)
-        if score == 0:
-            continue # no match whatsoever, dont include
-        # give a small boost to more recent papers
-        score += 0.0001*p['tscore']
-        scores.append((score, p))
-    scores.sort(reverse=True, key=lambda x: x[0]) # descending
-    out = [x[1] for x in scores if x[0] > 0]
+def current_bundle():
+    """ Returns the bundle used by the current request. A request keeps using the bundle it started
+    with, even if a new one is swapped in while it runs. """
+    if not has_request_context():
+        return BUNDLE
+    if 'bundle' not in g:
+        g.bundle = BUNDLE
+    return g.bundle
+
+
+@FUNCTION_SECONDS.time('papers_search')
+def papers_search(qraw, offset=0, limit=PAGE_SIZE):
+    """ Returns the papers in positions [offset, offset+limit) of the ranking, and the total number of matches. """
+    qnorm = ' '.join(qraw.lower().split())
+    papers, numresults = QUERY_CACHE.get_or_compute(
+        ('search', qnorm, offset, limit), lambda: _papers_search(qnorm, offset, limit), current_bundle().version)
+    RESULTS.observe(numresults, 'papers_search')
+    return papers, numresults
+
+
+def correct_term(q, max_terms=3):
+    """ Returns the search terms closest to an unknown query word, within a small edit distance. """
+    if len(q) < 4:
+        return [] # too short to guess what was meant
+    max_dist = 1 if len(q) < 8 else 2
+    search = current_bundle()['search']
+    trigram_rows, trigram_indptr, trigram_postings = search['trigram_rows'], search['trigram_indptr'], search['trigram_postings']
+    grams = [g for g in char_trigrams(q) if g in trigram_rows]
+    if len(grams) == 0:
+        return []
+    tids = np.concatenate([trigram_postings[trigram_indptr[trigram_rows[g]]:trigram_indptr[trigram_rows[g]+1]] for g in grams])
+    tids, shared = np.unique(tids, return_counts=True)
+    # each edit (a swap included) changes at most 4 trigrams, so closer terms must share at least this many
+    keep = shared >= max(len(char_trigrams(q)) - 4*max_dist, 1)
+    tids, shared = tids[keep], shared[keep]
+    dists = {}
+    term_names = current_bundle()['search_term_names']
+    for tid in tids[argsort_top_k(shared, 50)]:
+        d = edit_distance(q, term_names[tid], max_dist)
+        if d <= max_dist:
+            dists[tid] = d
+    if len(dists) == 0:
+        return []
+    best = min(dists.values())
+    return [tid for tid, d in dists.items() if d == best][:max_terms]
+
+
+def bigram_key(a, b):
+    """ Identifies the bigram "a b" in the bigram index, or returns None if any of the words is unknown. """
+    search = current_bundle()['search']
+    terms = search['terms']
+    if a not in terms or b not in terms:
+        return None
+    return terms[a]*search['matrix'].shape[1] + terms[b]
+
+
+def bigram_postings(key):
+    """ Returns the sorted indices of the papers containing a bigram. """
+    if key is None:
+        return np.zeros(0, dtype=np.int32)
+    search = current_bundle()['search']
+    keys = search['bigram_keys']
+    i = np.searchsorted(keys, key)
+    if i == len(keys) or keys[i] != key:
+        return np.zeros(0, dtype=np.int32)
+    return search['bigram_postings'][search['bigram_indptr'][i]:search['bigram_indptr'][i+1]]
+
+
+def phrase_postings(words):
+    """ Returns the sorted indices of the papers containing the phrase, by intersecting the postings of its bigrams. """
+    if len(words) == 1:
+        search = current_bundle()['search']
+        if words[0] not in search['terms']:
+            return np.zeros(0, dtype=np.int32)
+        tid = search['terms'][words[0]]
+        matrix = search['matrix']
+        return matrix.indices[matrix.indptr[tid]:matrix.indptr[tid+1]]
+    postings = sorted([bigram_postings(bigram_key(a, b)) for a, b in zip(words[:-1], words[1:])], key=len)
+    out = postings[0]
+    for p in postings[1:]:
+        out = np.intersect1d(out, p, assume_unique=True)
     return out
 
 
+def _papers_search(qraw, offset, limit):
+    search = current_bundle()['search']
+    search_terms, search_matrix = search['terms'], search['matrix']
+    # "quoted phrases" are at the odd positions, an unmatched quote is ignored
+    segments = qraw.split('"')
+    if len(segments) % 2 == 0:
+        unmatched = segments.pop()
+        segments[-1] += ' ' + unmatched
+    segments = [s.split() for s in segments] # split by spaces
+    phrases = [s for s in segments[1::2] if len(s) > 0]
+    qparts = [q for s in segments for q in s]
+    # the query becomes a sparse vector of term counts, and the scores a single sparse mat-vec
+    # words that are not in the index are replaced by the closest terms, to tolerate typos
+    tids = []
+    for q in qparts:
+        if q in search_terms:
+            tids.append(search_terms[q])
+        else:
+            tids.extend(correct_term(q))
+    if len(tids) == 0:
+        return [], 0 # no match whatsoever
+    qvec = sp.csc_matrix(
+        (np.ones(len(tids)), (tids, np.zeros(len(tids), dtype=np.int64))), shape=(search_matrix.shape[1], 1))
+    scores = search_matrix.dot(qvec)
+    scores.sort_indices()
+    idxs = scores.indices
+    scores = scores.data
+    # adjacent query words that form a bigram of the tfidf vocabulary score the papers containing that bigram
+    for s in segments:
+        for a, b in zip(s[:-1], s[1:]):
+            key = bigram_key(a, b)
+            if key in search['bigram_idf']:
+                scores[np.searchsorted(idxs, bigram_postings(key))] += search['bigram_idf'][key]
+    # the papers must contain all the quoted phrases
+    for words in phrases:
+        keep = np.isin(idxs, phrase_postings(words), assume_unique=True)
+        idxs, scores = idxs[keep], scores[keep]
+    # give a small boost to more recent papers
+    scores = scores + 0.0001*search['tscores'][idxs]
+    top = argsort_top_k(scores, offset+limit)[offset:] # descending, ties keep the db order
+    out = [current_bundle()['papers'].paper(i) for i in idxs[top]] # the papers are stored in the rows of the search matrix
+    return out, len(idxs)
+
+
+@FUNCTION_SECONDS.time('papers_similar')
 def papers_similar(pid, confs_filter):
+    if confs_filter is None or confs_filter == 'all':
+        confs_filter = 'all'
+    else:
+        confs_filter = ','.join(sorted(set(confs_filter.split(','))))
+    papers = QUERY_CACHE.get_or_compute(
+        ('similar', pid, confs_filter), lambda: _papers_similar(pid, confs_filter), current_bundle().version)
+    RESULTS.observe(len(papers), 'papers_similar')
+    return papers
+
+
+def _papers_similar(pid, confs_filter):
     # check if we have this paper at all, otherwise return empty list
-    if pid not in db: 
+    db = current_bundle()['papers']
+    row = db.row(pid)
+    if row < 0:
         return []
 
     # check if we have distances to this specific version of paper id (includes version)
-    if pid in sim_dict:
-        # good, simplest case: lets return the papers
-        if confs_filter == 'all':
-            return [db[pid]] + [db[k] for k in sim_dict[pid]]
-        else:
-            confs_filter = confs_filter.split(',')
-            if Config.include_workshop_papers:
-                confs_filter.extend([c+'W' for c in confs_filter])
-            return [db[pid]] + [db[k] for k in sim_dict[pid] if db[k]['conf_id'] in confs_filter]
+    tfidf_row = current_bundle()['db_to_tfidf'][row]
+    tfidf_to_db = current_bundle()['tfidf_to_db']
+    if 0 <= tfidf_row < len(current_bundle()['neighbors']):
+        # good, simplest case: the neighbors were precomputed
+        sim_rows, _ = current_bundle()['neighbors'].neighbors(tfidf_row)
+        sim_rows = tfidf_to_db[sim_rows]
+    elif tfidf_row >= 0:
+        # the paper was left out of the precomputation (e.g. it has no full text), so find its neighbors now
+        X = current_bundle()['tfidf']
+        sim_rows, _ = similar_rows(X, X[tfidf_row], SIMILAR_TOP_K, exclude=[tfidf_row], index=current_bundle()['ann_index'])
+        sim_rows = tfidf_to_db[sim_rows]
     else:
-        return [db[pid]]
-
-
-def encode_json(ps, n=10, send_images=True, send_abstracts=True):
-    ret = []
-    for i in range(min(len(ps),n)):
-        p = ps[i]
-        struct = {}
-        struct['title'] = p['title']
-        struct['pid'] = p['pid']
-        struct['authors'] = [a for a in p['authors']]
-        struct['link'] = p['page_url']
-        struct['pdf_link'] = p['pdf_url']
-        struct['conf_name'] = p['conf_name']
-        struct['composed_conf_id'] = p['composed_conf_id']
-        struct['bib_id'] = p['bib_id']
-        struct['bib_authors'] = p['bib_authors']
-        struct['bib_booktitle'] = p['bib_booktitle']
-        struct['year'] = p['year']
-        struct['code_link'] = ''
-        if 'code_link' in p:
-            struct['code_link'] = p['code_link']
-        if send_abstracts:
-            struct['abstract'] = p['summary']
-
-        # render time information nicely
-        timestruct = dateutil.parser.parse(p['published'])
-        struct['published_time'] = '%s/%s/%s' % (timestruct.month, timestruct.day, timestruct.year)
-        timestruct = dateutil.parser.parse(p['published'])
-
-        ret.append(struct)
-    return ret
+        # the paper is not in the tfidf matrix at all (e.g. it was added later), so use its abstract
+        p = db.paper(row)
+        x = current_bundle()['vectorizer'].transform(p['title'] + '. ' + p['summary'])
+        if not x.any():
+            # none of the words is in the vocabulary
+            return db.papers(np.array([row], dtype=np.int64))
+        sim_rows, _ = similar_rows(current_bundle()['tfidf'], x, SIMILAR_TOP_K, index=current_bundle()['ann_index'])
+        sim_rows = tfidf_to_db[sim_rows]
+        sim_rows = sim_rows[sim_rows != row]
+    sim_rows = sim_rows[sim_rows >= 0]
+    if confs_filter != 'all':
+        confs_filter = confs_filter.split(',')
+        if Config.include_workshop_papers:
+            confs_filter.extend([c+'W' for c in confs_filter])
+        confs = [i for i, conf_id in enumerate(db.conf_ids) if conf_id in confs_filter]
+        sim_rows = sim_rows[np.isin(db.conf[sim_rows], confs)]
+    return db.papers(np.concatenate([[row], sim_rows]).astype(np.int64))
+
+
+def tfidf_papers(rows):
+    """ Returns the papers of rows of the tfidf matrix, without the ones that are not in the db. """
+    rows = current_bundle()['tfidf_to_db'][rows]
+    return current_bundle()['papers'].papers(rows[rows >= 0])
+
+
+@FUNCTION_SECONDS.time('papers_similar_to_set')
+def papers_similar_to_set(pids, mode):
+    """ Returns the papers closest to a set of papers (e.g. a reading list), see similarity.similar_to_rows. """
+    rows = current_bundle()['papers'].rows(pids)
+    rows = current_bundle()['db_to_tfidf'][rows[rows >= 0]]
+    rows = tuple(sorted(set(int(row) for row in rows if row >= 0)))
+    papers = QUERY_CACHE.get_or_compute(
+        ('similar_set', rows, mode), lambda: _papers_similar_to_set(rows, mode), current_bundle().version)
+    RESULTS.observe(len(papers), 'papers_similar_to_set')
+    return papers
+
+
+def _papers_similar_to_set(rows, mode):
+    if len(rows) == 0:
+        return []
+    sim_rows, _ = similar_to_rows(current_bundle()['tfidf'], rows, SIMILAR_TOP_K, mode, index=current_bundle()['ann_index'])
+    return tfidf_papers(sim_rows)
+
+
+@FUNCTION_SECONDS.time('papers_similar_to_text')
+def papers_similar_to_text(text):
+    """ Returns the papers closest to an arbitrary text (e.g. a pasted abstract). """
+    text = ' '.join(text.split())
+    papers = QUERY_CACHE.get_or_compute(('similar_text', text), lambda: _papers_similar_to_text(text), current_bundle().version)
+    RESULTS.observe(len(papers), 'papers_similar_to_text')
+    return papers
+
+
+def _papers_similar_to_text(text):
+    x = current_bundle()['vectorizer'].transform(text)
+    if not x.any():
+        # none of the words is in the vocabulary
+        return []
+    rows, _ = similar_rows(current_bundle()['tfidf'], x, SIMILAR_TOP_K, index=current_bundle()['ann_index'])
+    return tfidf_papers(rows)
+
+
+@FUNCTION_SECONDS.time('encode_json')
+def encode_json(ps, n=10):
+    """ Returns the JSON list of the first n papers, joined from the records serialized by make_cache.py. """
+    return '[' + ','.join(p['json'] for p in ps[:n]) + ']'
+
+
+def render(template_name, **ctx):
+    with RENDER_SECONDS.time(template_name):
+        return render_template(template_name, **ctx)
+
+
+def json_response(papers_json, **kws):
+    """ Builds a JSON response with the fields in kws and the papers already encoded by encode_json. """
+    fields = ['"{:}": {:}'.format(k, json.dumps(v)) for k, v in kws.items()]
+    fields.append('"papers": ' + papers_json)
+    return app.response_class('{' + ', '.join(fields) + '}', mimetype='application/json')
+
+
+def papers_by_author(name):
+    """ Returns all the papers of an author, from the newest to the oldest. """
+    authors = current_bundle()['authors']
+    aid = authors['ids'].get(' '.join(name.lower().split()))
+    if aid is None:
+        return []
+    return current_bundle()['papers'].papers(authors['papers'][authors['indptr'][aid]:authors['indptr'][aid+1]])
+
+
+def suggest(prefix, limit=10):
+    """ Returns the most frequent title terms, authors and conference ids starting with prefix. """
+    prefix = ' '.join(prefix.lower().split())
+    if len(prefix) == 0:
+        return []
+    suggestions = current_bundle()['suggest']
+    keys, texts, kinds, counts = suggestions['keys'], suggestions['texts'], suggestions['kinds'], suggestions['counts']
+    lo = bisect.bisect_left(keys, prefix)
+    hi = bisect.bisect_left(keys, prefix + '\uffff', lo=lo)
+    # one author may be found by several keys (full name and last names), so take a few spares for the duplicates
+    top = lo + argsort_top_k(counts[lo:hi], 3*limit)
+    out = []
+    seen = set()
+    for i in top:
+        if texts[i] not in seen:
+            seen.add(texts[i])
+            out.append({'text': texts[i], 'kind': kinds[i], 'count': int(counts[i])})
+    return out[:limit]
 
 
 # -----------------------------------------------------------------------------
@@ -143,41 +401,207 @@ def gen_conferences_dict(conf_ids_list):
 # flask request handling
 # -----------------------------------------------------------------------------
 
-def default_context(papers, **kws):
-    top_papers = encode_json(papers, 200)
+def cached_page(key, render_fn):
+    """ Returns the response for a page that only depends on key and on the loaded files.
+
+    The page is rendered and compressed the first time it is requested, and clients that
+    already have it (same ETag) get a 304 instead.
+    """
+    def render_page():
+        body = render_fn().encode('utf-8')
+        return hashlib.md5(body).hexdigest(), body, gzip.compress(body)
+    etag, body, gzip_body = PAGE_CACHE.get_or_compute(key, render_page, current_bundle().version)
+    use_gzip = request.accept_encodings['gzip'] > 0
+    if use_gzip:
+        etag += '-gzip' # a different representation of the same page
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(gzip_body if use_gzip else body, mimetype='text/html')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache' # always revalidate, it is cheap with the ETag
+    return response
+
+
+def static_hash(filename):
+    if filename not in STATIC_HASHES:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            STATIC_HASHES[filename] = hashlib.md5(f.read()).hexdigest()[:12]
+    return STATIC_HASHES[filename]
+
+
+@app.url_defaults
+def add_static_hash(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['v'] = static_hash(values['filename'])
+
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+
+def profile_requested():
+    """ Whether the request has a valid signed profiling header. """
+    token = request.headers.get(PROFILE_HEADER)
+    if token is None or PROFILE_SIGNER is None:
+        return False
+    try:
+        PROFILE_SIGNER.loads(token, max_age=PROFILE_TOKEN_MAX_AGE)
+    except BadSignature:
+        return False
+    return True
+
+
+@app.before_request
+def start_profile():
+    g.profile = PROFILER.start(force=profile_requested())
+
+
+@app.before_request
+def check_bundle():
+    BUNDLE_WATCHER.check()
+
+
+@app.after_request
+def record_request(response):
+    route = request.endpoint or 'none'
+    REQUEST_SECONDS.observe(time.perf_counter() - g.get('start_time', time.perf_counter()), route)
+    REQUESTS.inc(route, str(response.status_code))
+    g.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def stop_profile(exc):
+    state = g.pop('profile', None)
+    if state is not None:
+        PROFILER.stop(state, {
+            'route': request.endpoint, 'method': request.method, 'path': request.path,
+            'args': request.args.to_dict(flat=False), 'json': request.get_json(silent=True),
+            'status': g.get('status', 500), 'bundle': current_bundle().version,
+        })
+
+
+@app.after_request
+def add_static_cache_headers(response):
+    # only the current content can be cached for good, a stale or made up hash must not pin it
+    if (request.endpoint == 'static' and response.status_code in (200, 304) and
+            request.args.get('v') == static_hash(request.view_args['filename'])):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def make_cursor(offset):
+    """ Cursors point to a position in the results computed from one version of the bundle. """
+    return '{:d}.{:}'.format(offset, current_bundle().version)
+
+
+def parse_cursor(cursor):
+    """ Returns the offset of a cursor, aborting if the results it points to are no longer available. """
+    if cursor is None:
+        return 0
+    offset, _, generation = cursor.partition('.')
+    if not (offset.isascii() and offset.isdigit()): # isdigit alone accepts digits that int() rejects, e.g. '²'
+        abort(400)
+    if generation != current_bundle().version:
+        abort(410) # the files were updated and the ranking may have changed since the first page
+    return int(offset)
+
+
+def api_page(fetch_page, **kws):
+    """ Returns one page of results as JSON, fetch_page(offset, limit) returns the papers and the total number of results. """
+    offset = parse_cursor(request.args.get('cursor', None))
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    papers, numresults = fetch_page(offset, limit)
+    next_offset = offset + len(papers)
+    next_cursor = make_cursor(next_offset) if next_offset < numresults else None
+    return json_response(encode_json(papers, limit), numresults=numresults, next_cursor=next_cursor, **kws)
+
+
+def default_context(papers, numresults=None, api_url=None, **kws):
+    top_papers = encode_json(papers, PAGE_SIZE)
+    if numresults is None:
+        numresults = len(papers)
 
     # prompt logic
     show_prompt = 'no'
 
     ans = dict(
-        papers=top_papers, numresults=len(papers), totpapers=len(db), 
+        papers=top_papers, numresults=numresults, totpapers=len(current_bundle()['papers']),
+        next_cursor=make_cursor(PAGE_SIZE) if numresults > PAGE_SIZE else None, api_url=api_url,
         msg='', show_prompt=show_prompt, pid_to_users={},
-        conferences=CONFERENCES, include_workshop_papers=Config.include_workshop_papers,
-        newest_conference_year=NEWEST_CONFERENCE_YEAR,
-        oldest_conference_year=OLDEST_CONFERENCE_YEAR)
+        conferences=current_bundle()['conferences_dict'], include_workshop_papers=Config.include_workshop_papers,
+        newest_conference_year=current_bundle()['conferences']['newest_conference_year'],
+        oldest_conference_year=current_bundle()['conferences']['oldest_conference_year'])
     ans.update(kws)
     return ans
 
 
+def conference_key(conf_str, year_str, type_str):
+    """ Returns the id of a conference in the bundle, or None if it does not exist. """
+    conferences = current_bundle()['conferences_dict']
+    if conf_str not in conferences or year_str not in conferences[conf_str] or type_str not in conferences[conf_str][year_str]:
+        return None
+    suffix = '' if type_str.lower() == 'main' else 'W'
+    return conf_str+year_str+suffix
+
+
+def conference_papers(key):
+    """ Returns the papers of a conference, in the db order. """
+    conferences = current_bundle()['conferences']
+    i = conferences['ids'][key]
+    return current_bundle()['papers'].papers(conferences['papers'][conferences['indptr'][i]:conferences['indptr'][i+1]])
+
+
 @app.route("/")
 def intmain():
     conf_str = request.args.get('conf', None)
     year_str = request.args.get('year', None)
     type_str = request.args.get('type', None)
-    if conf_str not in CONFERENCES or year_str not in CONFERENCES[conf_str] or type_str not in CONFERENCES[conf_str][year_str]:
-        if conf_str not in CONFERENCES:
-            conf_str = MOST_RECENT_CONFERENCE
-        if year_str not in CONFERENCES[conf_str]:
-            year_str = list(CONFERENCES[conf_str])[-1]
-        if type_str not in CONFERENCES[conf_str][year_str]:
+    key = conference_key(conf_str, year_str, type_str)
+    if key is None:
+        conferences = current_bundle()['conferences_dict']
+        if conf_str not in conferences:
+            conf_str = current_bundle()['conferences']['most_recent_conference_name']
+        if year_str not in conferences[conf_str]:
+            year_str = list(conferences[conf_str])[-1]
+        if type_str not in conferences[conf_str][year_str]:
             type_str = 'Main'
         return redirect(url_for('intmain', conf=conf_str, year=year_str, type=type_str))
     else:
-        suffix = '' if request.args.get('type', 'Main').lower() == 'main' else 'W'
-        papers = [db[pid] for pid in CONFERENCE_SORTED_PIDS[conf_str+year_str+suffix]] # precomputed
-        ctx = default_context(
-            papers, render_format='recent', msg='Showing papers from {:}{:} {:}'.format(conf_str, suffix, year_str))
-        return render_template('main.html', **ctx)
+        # pages rendered by prerender.py are sent straight from the disk
+        page_path = os.path.join(Config.prerender_dir, current_bundle().version, prerendered_page_name(conf_str, year_str, type_str))
+        if os.path.isfile(page_path):
+            return send_prerendered_page(page_path)
+        return cached_page(key, lambda: render_conference_page(conf_str, year_str, type_str))
+
+
+def render_conference_page(conf_str, year_str, type_str):
+    suffix = '' if type_str.lower() == 'main' else 'W'
+    papers = conference_papers(conference_key(conf_str, year_str, type_str)) # precomputed
+    ctx = default_context(
+        papers, numresults=len(papers), api_url=url_for('api_conference', conf=conf_str, year=year_str, type=type_str),
+        render_format='recent', msg='Showing papers from {:}{:} {:}'.format(conf_str, suffix, year_str))
+    return render('main.html', **ctx)
+
+
+def prerendered_page_name(conf_str, year_str, type_str):
+    return '{:}_{:}_{:}.html'.format(conf_str, year_str, type_str)
+
+
+def send_prerendered_page(page_path):
+    use_gzip = request.accept_encodings['gzip'] > 0 and os.path.isfile(page_path + '.gz')
+    # send_file handles the ETag and If-None-Match, and lets the WSGI server send the file without copying it
+    response = send_file(page_path + '.gz' if use_gzip else page_path, mimetype='text/html', conditional=True)
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 @app.route("/<request_pid>")
@@ -187,18 +611,115 @@ def rank(request_pid=None):
     confs_filter = request.args.get('confs', None)
     papers = papers_similar(request_pid, confs_filter)
     ctx = default_context(
-        papers, render_format='paper')
-    return render_template('main.html', **ctx)
+        papers, api_url=url_for('api_similar', request_pid=request_pid, confs=confs_filter),
+        render_format='paper')
+    return render('main.html', **ctx)
 
 
 @app.route("/search", methods=['GET'])
 def search():
     q = request.args.get('q', '') # get the search request
-    papers = papers_search(q) # perform the query and get sorted documents
+    papers, numresults = papers_search(q) # perform the query and get the top sorted documents
     ctx = default_context(
-        papers, render_format='search',
-        msg='Showing search results')
-    return render_template('main.html', **ctx)
+        papers, numresults=numresults, api_url=url_for('api_search', q=q),
+        render_format='search', msg='Showing search results')
+    return render('main.html', **ctx)
+
+
+@app.route("/author", methods=['GET'])
+def author():
+    name = request.args.get('name', '')
+    papers = papers_by_author(name)
+    ctx = default_context(
+        papers, api_url=url_for('api_author', name=name),
+        render_format='search', msg='Showing papers by {:}'.format(name))
+    return render('main.html', **ctx)
+
+
+@app.route("/api/conference", methods=['GET'])
+def api_conference():
+    key = conference_key(request.args.get('conf', None), request.args.get('year', None), request.args.get('type', None))
+    if key is None:
+        abort(404)
+    papers = conference_papers(key)
+    return api_page(lambda offset, limit: (papers[offset:offset+limit], len(papers)))
+
+
+@app.route("/api/search", methods=['GET'])
+def api_search():
+    q = request.args.get('q', '')
+    return api_page(lambda offset, limit: papers_search(q, offset, limit))
+
+
+@app.route("/api/similar/<request_pid>", methods=['GET'])
+def api_similar(request_pid):
+    papers = papers_similar(request_pid, request.args.get('confs', None))
+    return api_page(lambda offset, limit: (papers[offset:offset+limit], len(papers)))
+
+
+@app.route("/api/similar_set", methods=['GET', 'POST'])
+def api_similar_set():
+    """ More like these: the pids are given as a comma-separated 'pids' argument, or in a POST as a JSON list
+    or as a JSON object with a 'pids' list. """
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        pids = body.get('pids', []) if isinstance(body, dict) else body
+    else:
+        pids = request.args.get('pids', '').split(',')
+    mode = request.args.get('mode', 'centroid')
+    if mode not in ('centroid', 'max') or not isinstance(pids, list) or len(pids) > MAX_SET_SIZE:
+        abort(400)
+    papers = papers_similar_to_set([str(pid) for pid in pids], mode)
+    return api_page(lambda offset, limit: (papers[offset:offset+limit], len(papers)), mode=mode)
+
+
+@app.route("/api/similar_text", methods=['GET', 'POST'])
+def api_similar_text():
+    """ Papers similar to a pasted text, given as a 'text' argument, form field or JSON attribute. """
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if body is None:
+            body = request.form
+        if not isinstance(body, dict):
+            abort(400)
+        text = body.get('text', '')
+    else:
+        text = request.args.get('text', '')
+    if not isinstance(text, str) or len(text) > MAX_TEXT_LENGTH:
+        abort(400)
+    papers = papers_similar_to_text(text)
+    return api_page(lambda offset, limit: (papers[offset:offset+limit], len(papers)))
+
+
+@app.route("/api/author", methods=['GET'])
+def api_author():
+    name = request.args.get('name', '')
+    papers = papers_by_author(name)
+    return api_page(lambda offset, limit: (papers[offset:offset+limit], len(papers)), name=name)
+
+
+@app.route("/api/suggest", methods=['GET'])
+def api_suggest():
+    prefix = request.args.get('prefix', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    return jsonify(prefix=prefix, suggestions=suggest(prefix, limit))
+
+
+@app.route("/api/cache_stats", methods=['GET'])
+def cache_stats():
+    return jsonify(queries=QUERY_CACHE.stats(), pages=PAGE_CACHE.stats())
+
+
+@app.route("/api/startup", methods=['GET'])
+def startup():
+    """ How long this process took to start, and what it loaded from the bundle so far. """
+    return jsonify(startup_seconds=STARTUP_SECONDS, bundle=current_bundle().report())
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """ The metrics of this process, in the Prometheus text format. """
+    return app.response_class(METRICS.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route("/info", methods=['GET'])
@@ -206,46 +727,94 @@ def info():
     ctx = default_context(
         [], render_format='search',
         msg='Showing search results')
-    return render_template('info.html', **ctx)
-
-print('loading the paper database', Config.db_serve_path)
-db = pickle.load(open(Config.db_serve_path, 'rb'))
+    return render('info.html', **ctx)
+
+# the files are loaded from the bundle when a request first needs them, along with these values derived from them
+BUNDLE_DERIVED = {
+    'search_term_names': lambda b: sorted(b['search']['terms'], key=b['search']['terms'].get), # column -> term
+    'conferences_dict': lambda b: gen_conferences_dict(list(b['conferences']['ids'])),
+    'tfidf_to_db': lambda b: b['papers'].rows(b['meta']['pids']), # row of the db of each row of the tfidf matrix, or -1
+    'db_to_tfidf': lambda b: invert_rows(b['tfidf_to_db'], len(b['papers'])),
+    'ann_index': lambda b: b['ann'] if b['tfidf'].shape[0] >= Config.ann_min_papers else None,
+}
+
+
+def invert_rows(rows, n):
+    out = np.full(n, -1, dtype=np.int64)
+    found = np.flatnonzero(rows >= 0)
+    out[rows[found]] = found
+    return out
 
-print('loading tfidf_meta', Config.meta_path)
-meta = pickle.load(open(Config.meta_path, "rb"))
-vocab = meta['vocab']
-idf = meta['idf']
 
-print('loading paper similarities', Config.sim_path)
-sim_dict = pickle.load(open(Config.sim_path, "rb"))
+def swap_bundle(bundle):
+    """ Makes the requests that start from now on use a new bundle, loaded by BUNDLE_WATCHER. """
+    global BUNDLE
+    BUNDLE = bundle
+    QUERY_CACHE.invalidate(bundle.version)
+    PAGE_CACHE.invalidate(bundle.version)
 
-print('loading serve cache...', Config.serve_cache_path)
-cache = pickle.load(open(Config.serve_cache_path, "rb"))
-CONFERENCE_SORTED_PIDS = cache['conference_sorted_pids']
-SEARCH_DICT = cache['search_dict']
 
-CONFERENCES = gen_conferences_dict(list(cache['conference_sorted_pids']))
-MOST_RECENT_CONFERENCE = cache['most_recent_conference_name']
-NEWEST_CONFERENCE_YEAR = cache['newest_conference_year']
-OLDEST_CONFERENCE_YEAR = cache['oldest_conference_year']
+print('opening the bundle', Config.bundle_dir)
+BUNDLE = Bundle(Config.bundle_dir, derived=BUNDLE_DERIVED)
+QUERY_CACHE.invalidate(BUNDLE.version)
+PAGE_CACHE.invalidate(BUNDLE.version)
+BUNDLE_WATCHER = BundleWatcher(BUNDLE, swap_bundle, interval=RELOAD_CHECK_SECONDS)
+STARTUP_SECONDS = round(time.time() - STARTUP_TIME, 6)
+print('started in {:.3f}s with bundle version {:} ({:})'.format(STARTUP_SECONDS, BUNDLE.version, BUNDLE.manifest['created']))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--prod', dest='prod', action='store_true', help='run in prod?')
     parser.add_argument('--port', dest='port', type=int, default=5000, help='port to serve on')
+    parser.add_argument('--threads', dest='threads', type=int, default=16,
+                        help='with --prod, number of threads running the requests (0: all on the event loop)')
+    parser.add_argument('--processes', dest='processes', type=int, default=1,
+                        help='with --prod, number of server processes (0: one per CPU)')
+    parser.add_argument('--profile-slow', dest='profile_slow', type=float, default=Config.profile_slow_seconds,
+                        help='write the sampled stacks of the requests slower than this many seconds')
+    parser.add_argument('--profile-one-in', dest='profile_one_in', type=int, default=Config.profile_one_in,
+                        help='profile one in every this many requests with cProfile')
+    parser.add_argument('--profile-token', dest='profile_token', action='store_true',
+                        help='print a token for the {:} header, which profiles a request, and exit'.format(PROFILE_HEADER))
+    parser.add_argument('--startup-report', dest='startup_report', action='store_true',
+                        help='load the whole bundle, print the loading times as JSON and exit')
     args = parser.parse_args()
     print(args)
+    if args.profile_token:
+        if PROFILE_SIGNER is None:
+            raise SystemExit('the profiling tokens need a secret_key.txt')
+        print(PROFILE_SIGNER.dumps('profile'))
+        raise SystemExit
+    PROFILER.slow_seconds = args.profile_slow
+    PROFILER.one_in = args.profile_one_in
+    if args.startup_report:
+        BUNDLE.load_all()
+        print(json.dumps({'startup_seconds': STARTUP_SECONDS, 'bundle': BUNDLE.report()}, indent=1))
+        raise SystemExit
     if args.prod:
         # run on Tornado instead, since running raw Flask in prod is not recommended
         print('starting tornado!')
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
         from tornado.wsgi import WSGIContainer
         from tornado.httpserver import HTTPServer
-        from tornado.ioloop import IOLoop
         from tornado.log import enable_pretty_logging
+        from tornado.netutil import bind_sockets
+        from tornado.process import fork_processes
         enable_pretty_logging()
-        http_server = HTTPServer(WSGIContainer(app))
-        http_server.listen(args.port)
-        IOLoop.instance().start()
+        sockets = bind_sockets(args.port)
+        if args.processes != 1:
+            # the processes share the connections, and the pages of the memory-mapped bundle
+            fork_processes(args.processes)
+
+        async def run_server():
+            # the requests run on a pool of threads, while the asyncio loop keeps accepting and answering
+            # the connections: a slow search only holds its own thread instead of every other connection
+            executor = ThreadPoolExecutor(max_workers=args.threads, thread_name_prefix='request') if args.threads > 0 else None
+            http_server = HTTPServer(WSGIContainer(app, executor=executor))
+            http_server.add_sockets(sockets)
+            await asyncio.Event().wait()
+        asyncio.run(run_server())
     else:
         print('starting flask!')
         app.debug = False
@@ -0,0 +1,387 @@
+"""
+Utilities to store the tfidf matrix computed by analyze.py in a binary
+layout that the server can memory-map, to transform new text into the same
+tfidf space, and to find the nearest neighbors of papers on demand, exactly
+or approximately with a random-projection LSH index.
+"""
+
+import json
+import os
+import re
+import unicodedata
+from collections import Counter, namedtuple
+
+import numpy as np
+import scipy.sparse as sp
+
+from utils import open_atomic
+
+
+def save_csr(X, dirpath):
+    """ Saves the arrays of a CSR matrix as .npy files in dirpath, so they can be memory-mapped by load_csr. """
+    X = sp.csr_matrix(X, dtype=np.float32)
+    X.sort_indices()
+    # indices and indptr share the dtype, otherwise scipy casts (and copies) them when loading
+    idx_dtype = np.int32 if X.nnz < 2**31 else np.int64
+    os.makedirs(dirpath, exist_ok=True)
+    arrays = {
+        'data': X.data,
+        'indices': X.indices.astype(idx_dtype),
+        'indptr': X.indptr.astype(idx_dtype),
+        'shape': np.array(X.shape, dtype=np.int64)}
+    for name, arr in arrays.items():
+        with open_atomic(os.path.join(dirpath, name + '.npy'), 'wb') as f:
+            np.save(f, arr)
+
+
+def load_csr(dirpath, mmap_mode='r'):
+    """ Loads a matrix saved by save_csr. The arrays are memory-mapped, so the pages are shared between processes
+    and only read from the disk when used. """
+    arrays = {
+        name: np.load(os.path.join(dirpath, name + '.npy'), mmap_mode=mmap_mode)
+        for name in ['data', 'indices', 'indptr']}
+    shape = tuple(np.load(os.path.join(dirpath, 'shape.npy')))
+    return sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+
+
+class NeighborTable(object):
+    """ The neighbors precomputed by analyze.py for the first rows of the tfidf matrix.
+
+    Row i of the int32 neighbors matrix holds the rows of the tfidf matrix most similar to row i,
+    by decreasing similarity and padded with -1, with their float16 scores. The extra neighbors
+    added for the recent conferences are stored in a ragged section after them.
+    """
+    def __init__(self, dirpath, mmap_mode='r'):
+        def load(name):
+            return np.load(os.path.join(dirpath, name + '.npy'), mmap_mode=mmap_mode)
+        self.top = load('neighbors')
+        self.top_scores = load('scores')
+        self.extras_indptr = load('extras_indptr')
+        self.extras = load('extras')
+        self.extras_scores = load('extras_scores')
+
+    @staticmethod
+    def save(dirpath, top, top_scores, extras, extras_scores):
+        """ Writes the neighbors given as lists of arrays (of rows and scores) for each row to dirpath. """
+        k = max([len(t) for t in top] + [0])
+        neighbors = np.full((len(top), k), -1, dtype=np.int32)
+        scores = np.zeros((len(top), k), dtype=np.float16)
+        for i, (t, s) in enumerate(zip(top, top_scores)):
+            neighbors[i, :len(t)] = t
+            scores[i, :len(s)] = s
+        extras_indptr = np.zeros(len(extras) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in extras], out=extras_indptr[1:])
+        os.makedirs(dirpath, exist_ok=True)
+        arrays = {
+            'neighbors': neighbors, 'scores': scores, 'extras_indptr': extras_indptr,
+            'extras': np.concatenate([np.zeros(0)] + list(extras)).astype(np.int32),
+            'extras_scores': np.concatenate([np.zeros(0)] + list(extras_scores)).astype(np.float16)}
+        for name, arr in arrays.items():
+            with open_atomic(os.path.join(dirpath, name + '.npy'), 'wb') as f:
+                np.save(f, arr)
+
+    def __len__(self):
+        return len(self.top)
+
+    def neighbors(self, row):
+        """ Returns the neighbors of a row, followed by its extra neighbors, and their scores. """
+        top = np.asarray(self.top[row])
+        n = np.count_nonzero(top >= 0)
+        a, b = self.extras_indptr[row], self.extras_indptr[row+1]
+        rows = np.concatenate([top[:n], self.extras[a:b]]).astype(np.int64)
+        scores = np.concatenate([self.top_scores[row, :n], self.extras_scores[a:b]]).astype(np.float32)
+        return rows, scores
+
+
+def make_tfidf_vectorizer(max_features=5000):
+    """ The scikit-learn TfidfVectorizer fitted by analyze.py, which TextVectorizer reproduces. """
+    from sklearn.feature_extraction.text import TfidfVectorizer  # only needed offline, not by the server
+    return TfidfVectorizer(
+        input='content',
+        encoding='utf-8', decode_error='replace', strip_accents='unicode',
+        lowercase=True, analyzer='word', stop_words='english',
+        token_pattern=r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b',
+        ngram_range=(1, 2), max_features = max_features,
+        norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=True,
+        max_df=1.0, min_df=1)
+
+
+class TextVectorizer(object):
+    """ Transforms text into the tfidf space computed by analyze.py, without scikit-learn.
+
+    It reproduces the transform of the TfidfVectorizer fitted there (accents stripping,
+    token pattern, stop words, n-grams, sublinear tf, idf and L2 normalization), from a
+    small JSON file with its vocabulary and idf.
+    """
+    def __init__(self, vocab, idf, stop_words, token_pattern, ngram_range):
+        self.vocab = vocab  # term -> column
+        self.idf = np.asarray(idf, dtype=np.float32)
+        self.stop_words = frozenset(stop_words)
+        self.token_pattern = token_pattern
+        self.ngram_range = tuple(ngram_range)
+        self._token_re = re.compile(token_pattern)
+
+    @classmethod
+    def from_sklearn(cls, v):
+        return cls(
+            {w: int(i) for w, i in v.vocabulary_.items()}, v.idf_.tolist(), sorted(v.get_stop_words() or []),
+            v.token_pattern, v.ngram_range)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            d = json.load(f)
+        return cls(
+            {w: i for i, w in enumerate(d['terms'])}, d['idf'], d['stop_words'], d['token_pattern'], d['ngram_range'])
+
+    def save(self, path):
+        terms = sorted(self.vocab, key=self.vocab.get)
+        with open_atomic(path, 'w') as f:
+            json.dump({
+                'terms': terms, 'idf': self.idf.tolist(), 'stop_words': sorted(self.stop_words),
+                'token_pattern': self.token_pattern, 'ngram_range': list(self.ngram_range)}, f)
+
+    def terms(self, text):
+        text = text.lower()
+        try:
+            text.encode('ascii')
+        except UnicodeEncodeError:
+            text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+        tokens = [w for w in self._token_re.findall(text) if w not in self.stop_words]
+        min_n, max_n = self.ngram_range
+        out = []
+        for n in range(min_n, max_n + 1):
+            out.extend(' '.join(tokens[i:i+n]) for i in range(len(tokens) - n + 1))
+        return out
+
+    def transform(self, text):
+        """ Returns the L2-normalized tfidf vector of text as a dense array. """
+        x = np.zeros(len(self.idf), dtype=np.float32)
+        counts = Counter(self.vocab[t] for t in self.terms(text) if t in self.vocab)
+        if len(counts) > 0:
+            cols = np.fromiter(counts.keys(), dtype=np.int64)
+            tf = np.fromiter(counts.values(), dtype=np.float32)
+            x[cols] = (1.0 + np.log(tf)) * self.idf[cols]
+            x /= np.linalg.norm(x)
+        return x
+
+
+def argsort_top_k(scores, k):
+    """ Returns the indices of the k largest scores in descending order, without sorting
+    the whole array. Ties are kept in index order, as in a stable sort. """
+    if k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    # everything that ties with the k-th score is a candidate, so the stable order is preserved
+    kth_score = np.partition(scores, len(scores)-k)[len(scores)-k]
+    candidates = np.flatnonzero(scores >= kth_score)
+    order = np.argsort(-scores[candidates], kind='stable')
+    return candidates[order[:k]]
+
+
+def top_scores(scores, k, exclude=()):
+    """ Returns the indices of the k largest scores (ignoring the ones in exclude), and the scores. """
+    scores[list(exclude)] = -np.inf
+    top = argsort_top_k(scores, min(k, len(scores) - len(exclude)))
+    return top, scores[top]
+
+
+def similar_rows(X, query, k, exclude=(), index=None):
+    """ Returns the k rows of X closest to the query vector, and their scores.
+
+    The rows of X and the query are L2-normalized, so the scores are cosine similarities,
+    computed with a single sparse mat-vec over the whole matrix, or only over the candidates
+    of an LSHIndex when one is given.
+    """
+    if sp.issparse(query):
+        query = query.toarray()
+    query = np.asarray(query, dtype=X.dtype).ravel()
+    if index is None:
+        return top_scores(X.dot(query), k, exclude)
+    rows = np.setdiff1d(index.candidates(query), np.asarray(exclude, dtype=np.int64))
+    top, scores = top_scores(X[rows].dot(query), k)
+    return rows[top], scores
+
+
+class LSHIndex(object):
+    """ Approximate nearest neighbors of the rows of an L2-normalized matrix, for cosine similarity.
+
+    Each of the n_tables hash tables projects the vectors on n_bits random hyperplanes, and the
+    signs of the projections form the bucket of a vector. The candidates of a query are the rows
+    in its buckets, and in the n_probes neighboring buckets (one flipped bit) of each table,
+    which are then scored exactly. See ann_report.py for the recall of the parameters.
+    """
+    def __init__(self, planes, keys, rows, n_probes=2):
+        self.planes = planes  # D x (n_tables * n_bits) random hyperplanes
+        self.keys = keys  # n_tables x N, sorted bucket of each row
+        self.rows = rows  # n_tables x N, rows in the order of keys
+        self.n_tables = keys.shape[0]
+        self.n_bits = planes.shape[1] // self.n_tables
+        self.n_probes = min(n_probes, self.n_bits)
+
+    @staticmethod
+    def default_bits(n):
+        """ Number of bits so that the buckets hold about 32 rows. """
+        return int(np.clip(np.round(np.log2(max(n, 1) / 32.0)), 1, 30))
+
+    @classmethod
+    def build(cls, X, n_tables=16, n_bits=None, n_probes=2, seed=0):
+        if n_bits is None:
+            n_bits = cls.default_bits(X.shape[0])
+        rng = np.random.RandomState(seed)
+        planes = rng.standard_normal((X.shape[1], n_tables * n_bits)).astype(np.float32)
+        codes = cls._codes(np.asarray(X.dot(planes)), n_tables, n_bits).T  # n_tables x N
+        rows = np.argsort(codes, axis=1, kind='stable').astype(np.int32)
+        return cls(planes, np.take_along_axis(codes, rows, axis=1), rows, n_probes)
+
+    @staticmethod
+    def _codes(projections, n_tables, n_bits):
+        bits = (projections > 0).reshape(-1, n_tables, n_bits).astype(np.int32)
+        return (bits << np.arange(n_bits, dtype=np.int32)).sum(axis=2, dtype=np.int32)
+
+    def candidates(self, query):
+        """ Returns the sorted rows that share a bucket with the query vector in at least one table. """
+        if sp.issparse(query):
+            query = query.toarray()
+        projections = np.asarray(query, dtype=np.float32).ravel().dot(self.planes)
+        codes = self._codes(projections, self.n_tables, self.n_bits)[0]
+        # probe the buckets of the bits whose hyperplanes are the closest to the query
+        margins = np.abs(projections).reshape(self.n_tables, self.n_bits)
+        flips = np.argsort(margins, axis=1)[:, :self.n_probes]
+        probes = np.concatenate([codes[:, None], codes[:, None] ^ (1 << flips)], axis=1)
+        out = []
+        for t in range(self.n_tables):
+            lo = np.searchsorted(self.keys[t], probes[t], side='left')
+            hi = np.searchsorted(self.keys[t], probes[t], side='right')
+            out.extend(self.rows[t][a:b] for a, b in zip(lo, hi) if b > a)
+        if len(out) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(out)).astype(np.int64)
+
+    def save(self, dirpath):
+        os.makedirs(dirpath, exist_ok=True)
+        arrays = {
+            'planes': self.planes, 'keys': self.keys, 'rows': self.rows,
+            'n_probes': np.array(self.n_probes, dtype=np.int64)}
+        for name, arr in arrays.items():
+            with open_atomic(os.path.join(dirpath, name + '.npy'), 'wb') as f:
+                np.save(f, arr)
+
+    @classmethod
+    def load(cls, dirpath, mmap_mode='r'):
+        arrays = {
+            name: np.load(os.path.join(dirpath, name + '.npy'), mmap_mode=mmap_mode)
+            for name in ['planes', 'keys', 'rows']}
+        n_probes = int(np.load(os.path.join(dirpath, 'n_probes.npy')))
+        return cls(arrays['planes'], arrays['keys'], arrays['rows'], n_probes)
+
+
+def recall_at_k(X, index, queries, ks):
+    """ Returns the mean recall@k of the index for each k, and the mean number of candidates,
+    measured against the exact neighbors of the given query rows (the row itself excluded). """
+    hits = np.zeros(len(ks))
+    num_candidates = 0
+    for row in queries:
+        query = X[row].toarray().ravel()
+        exact, _ = similar_rows(X, query, max(ks), exclude=[row])
+        approx, _ = similar_rows(X, query, max(ks), exclude=[row], index=index)
+        num_candidates += len(index.candidates(query))
+        for j, k in enumerate(ks):
+            hits[j] += len(np.intersect1d(exact[:k], approx[:k])) / float(min(k, len(exact)))
+    return hits / len(queries), num_candidates / float(len(queries))
+
+
+def similar_to_rows(X, rows, k, mode='centroid', index=None, block_elements=2**20):
+    """ Returns the k rows of X closest to a set of its rows, and their scores.
+
+    With mode='centroid' the rows are compared to the normalized mean of the set, and with
+    mode='max' to their most similar row of the set. Either way the whole matrix is scored
+    at once, in one mat-vec (centroid) or in products with dense blocks of the set (max),
+    each of at most block_elements scores so that the memory does not grow with the set.
+    An LSHIndex, if given, restricts the centroid search to its candidates.
+    """
+    rows = sorted(set(rows))
+    Q = X[rows]
+    if mode == 'centroid':
+        centroid = np.asarray(Q.mean(axis=0)).ravel()
+        norm = np.linalg.norm(centroid)
+        return similar_rows(X, centroid / norm if norm > 0 else centroid, k, exclude=rows, index=index)
+    elif mode == 'max':
+        step = max(block_elements // X.shape[0], 1)
+        scores = np.full(X.shape[0], -np.inf)
+        for i in range(0, len(rows), step):
+            np.maximum(scores, np.asarray(X.dot(Q[i:i+step].T.toarray())).max(axis=1), out=scores)
+        return top_scores(scores, k, exclude=rows)
+    raise ValueError('Unknown mode: {:}'.format(mode))
+
+
+# the conference of a paper, the name without the year (e.g. 'CVPR') and the lowercase sub id (e.g. 'main')
+PidConf = namedtuple('PidConf', 'pid, name, year, subid')
+
+
+# Counts how many papers in the latest conferences are already in the top picks
+def count_conference_papers(top_rows, pid_confs, newest_conf_years):
+    counters = {conf_name: 0 for conf_name in newest_conf_years}
+    for q in top_rows:
+        pc = pid_confs[q]
+        if pc.subid == 'main' and pc.year == newest_conf_years[pc.name]:
+            counters[pc.name] += 1
+    return counters
+
+
+# Find more top papers until all latest conferences have at least top_k_by_conf papers in the list,
+# returns their ranks in sort_idx
+def get_top_ranks_by_conference(top_k, top_k_by_conf, conf_counters, newest_conf_years, sort_idx, pid_confs):
+    filtered_ranks = [
+        r for r in range(top_k, len(sort_idx))
+        if pid_confs[sort_idx[r]].subid == 'main' and
+        pid_confs[sort_idx[r]].year == newest_conf_years[pid_confs[sort_idx[r]].name]]
+    conf_top_ranks = []
+    for r in filtered_ranks:
+        pc = pid_confs[sort_idx[r]]
+        if conf_counters[pc.name] < top_k_by_conf:
+            conf_top_ranks.append(r)
+            conf_counters[pc.name] += 1
+    return conf_top_ranks
+
+
+def precompute_neighbors(X, pid_confs, newest_conf_years, top_k=500, top_k_by_conf=50, index=None, batch_size=200):
+    """ Finds the neighbors of every row of X among the rows of X, and the extra neighbors from the latest
+    edition of each conference, as given to NeighborTable.save. pid_confs has the conference (name, year and
+    subid) of every row. The neighbors are found with the candidates of an LSHIndex if one is given, and
+    exactly in batches of rows otherwise. """
+    top, top_scores, extras, extras_scores = [], [], [], []
+
+    # the neighbors of a paper, from the indices of the papers sorted by decreasing similarity (the paper
+    # itself first) and their scores
+    def add_neighbors(sort_idx, sorted_scores):
+        conf_counters = count_conference_papers(sort_idx[1:top_k], pid_confs, newest_conf_years)
+        conf_top_ranks = get_top_ranks_by_conference(top_k, top_k_by_conf, conf_counters, newest_conf_years, sort_idx, pid_confs)
+        # copies, the slices would keep the whole (batch of) sorted arrays alive
+        top.append(np.array(sort_idx[1:top_k], dtype=np.int32))
+        top_scores.append(np.array(sorted_scores[1:top_k], dtype=np.float16))
+        extras.append(np.array(sort_idx[conf_top_ranks], dtype=np.int32))
+        extras_scores.append(np.array(sorted_scores[conf_top_ranks], dtype=np.float16))
+
+    n = X.shape[0]
+    if index is not None:
+        for i in range(n):
+            candidates = index.candidates(X[i])
+            candidates = candidates[candidates < n] # only the rows of X, as in the exact search
+            scores = X[candidates].dot(X[i].T).toarray().ravel()
+            order = np.argsort(-scores, kind='stable')
+            add_neighbors(candidates[order], scores[order])
+            if i % 1000 == 0:
+                print('%d/%d...' % (i, n))
+    else:
+        X = X.todense() # originally it's a sparse matrix
+        for i in range(0, n, batch_size):
+            i1 = min(n, i+batch_size)
+            xquery = X[i:i1] # BxD
+            ds = -np.asarray(np.dot(X, xquery.T)) #NxD * DxB => NxB
+            IX = np.argsort(ds, axis=0) # NxB
+            for j in range(i1-i):
+                add_neighbors(IX[:, j], -ds[IX[:, j], j])
+            print('%d/%d...' % (i, n))
+    return top, top_scores, extras, extras_scores
@@ -29,7 +29,7 @@ function jq( myid ) { return myid.replace( /(:|\.|\[|\]|,)/g, "\\$1" ); } // for
 function buildAuthorsHtml(authors) {
   let res = '';
   for(let i=0,n=authors.length;i<n;i++) {
-    let link = '/search?q=' + authors[i].replace(/ /g, "+");
+    let link = '/author?name=' + encodeURIComponent(authors[i]);
     res += '<a href="' + link + '">' + authors[i] + '</a>';
     if(i<n-1) res += ', ';
   }
@@ -49,13 +49,8 @@ function addPapers(num, dynamic) {
   for(let i=0;i<num;i++) {
     let ix = base_ix + i;
     if(ix >= papers.length) {
-      if(!showed_end_msg) {
-        if (ix >= numresults){
-          let msg = 'Results complete.';
-        } else {
-          let msg = 'You hit the limit of number of papers to show in one result.';
-        }
-        root.append('div').classed('alert alert-primary', true).attr('role', 'alert').html(msg);
+      if(next_cursor === null && !showed_end_msg) {
+        root.append('div').classed('alert alert-primary', true).attr('role', 'alert').html('Results complete.');
         showed_end_msg = true;
       }
       break;
@@ -148,7 +143,38 @@ function addPapers(num, dynamic) {
     }
   }
 
-  return pointer_ix >= papers.length; // are we done?
+  return pointer_ix >= papers.length && next_cursor === null; // are we done?
+}
+
+// like addPapers, but fetches the next page of papers from the server when the ones we have run out
+let fetching_page = false;
+function loadMorePapers(num) {
+  if(pointer_ix + num <= papers.length || next_cursor === null) {
+    return addPapers(num, true);
+  }
+  if(!fetching_page) {
+    fetching_page = true;
+    $.getJSON(api_url, {cursor: next_cursor}, function(data){
+      papers = papers.concat(data.papers);
+      next_cursor = data.next_cursor;
+      let done = addPapers(num, true);
+      if(done) { $("#loadmorebtn").hide(); }
+    }).fail(function(jqxhr){
+      next_cursor = null;
+      // show the papers we already have, then why there are no more instead of "Results complete."
+      showed_end_msg = true;
+      addPapers(papers.length - pointer_ix, true);
+      $("#loadmorebtn").hide();
+      let msg = 'Could not load more papers, please try again later.';
+      if(jqxhr.status === 410) {
+        msg = 'The results changed since this page was loaded, reload the page to see the new ones.'; // the database was updated
+      }
+      d3.select("#rtable").append('div').classed('alert alert-warning', true).attr('role', 'alert').text(msg);
+    }).always(function(){
+      fetching_page = false;
+    });
+  }
+  return false;
 }
 
 // code gotten from: https://www.guru99.com/cookies-in-javascript-ultimate-guide.html
@@ -10,7 +10,7 @@ $(document).ready(function(){
 
   // display message, if any
   if(msg !== '') {
-    d3.select("#rtable").append('div').classed('alert alert-primary', true).attr('role', 'alert').html(msg);
+    d3.select("#rtable").append('div').classed('alert alert-primary', true).attr('role', 'alert').text(msg);
   }
 
   // add papers to #rtable
@@ -24,14 +24,14 @@ $(document).ready(function(){
     let body_height = $(document).height() - window_height;
     let scroll_percentage = (scroll_top / body_height);
     if(scroll_percentage > 0.9) {
-      let done = addPapers(5, true);
+      let done = loadMorePapers(5);
       if(done) { $("#loadmorebtn").hide(); }
     }
   });
 
   // just in case scrolling is broken somehow, provide a button handler explicit
   $("#loadmorebtn").on('click', function(){
-    let done = addPapers(5, true);
+    let done = loadMorePapers(5);
     if(done) { $("#loadmorebtn").hide(); }
   });
 
@@ -41,6 +41,23 @@ $(document).ready(function(){
     d3.select("#qfield").attr('value', urlq.replace(/\+/g, " "));
   }
 
+  // suggest authors, title terms and conferences while the user types
+  let suggest_timer = null;
+  $("#qfield").on('input', function(){
+    let prefix = $(this).val();
+    clearTimeout(suggest_timer);
+    suggest_timer = setTimeout(function(){
+      if(prefix.trim().length === 0) { return; }
+      $.getJSON('/api/suggest', {prefix: prefix}, function(data){
+        let datalist = d3.select("#qsuggest");
+        datalist.selectAll('option').remove();
+        for(let i=0; i<data.suggestions.length; i++) {
+          datalist.append('option').attr('value', data.suggestions[i].text);
+        }
+      });
+    }, 150);
+  });
+
   let link_endpoint = '';
 
   // add conference links
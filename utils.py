@@ -1,9 +1,12 @@
+from collections import OrderedDict
 from contextlib import contextmanager
 
+import hashlib
 import json
 import os
 import pickle
 import tempfile
+import threading
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -15,6 +18,9 @@ class Config(object):
     include_workshop_papers = True
     suffix = '_' + str(minimum_year)
     suffix += '_wshop' if include_workshop_papers else ''
+    # from this many papers on, the neighbors are found with the approximate index (see ann_report.py)
+    ann_min_papers = 20000
+    ann_min_recall = 0.95  # unless its recall@500 on a sample of the papers is below this, then the search is exact
 
     # main paper information repo file
     db_path = os.path.join(ROOT_DIR, 'db.p')
@@ -25,12 +31,19 @@ class Config(object):
     # intermediate pickles
     tfidf_path = os.path.join(ROOT_DIR, 'tfidf{:}.p'.format(suffix))
     meta_path = os.path.join(ROOT_DIR, 'tfidf_meta{:}.p'.format(suffix))
-    sim_path = os.path.join(ROOT_DIR, 'sim_dict{:}.p'.format(suffix))
     # sql database file
     db_serve_path = os.path.join(ROOT_DIR, 'db2{:}.p'.format(suffix))  # an enriched db.p with various preprocessing info
-    serve_cache_path = os.path.join(ROOT_DIR, 'serve_cache{:}.p'.format(suffix))
+    # everything the server reads, see bundle.py
+    bundle_dir = os.path.join(ROOT_DIR, 'bundle{:}'.format(suffix))
     # papers JSON metadata
     json_dir = os.path.join(ROOT_DIR, 'data', 'json')
+    # conference listing pages rendered by prerender.py, in one folder per version of the bundle
+    prerender_dir = os.path.join(ROOT_DIR, 'data', 'pages')
+    # profiles of the requests written by serve.py, see profiling.py
+    profile_dir = os.path.join(ROOT_DIR, 'data', 'profiles')
+    profile_slow_seconds = None  # sample the stacks of the requests, and keep those of the requests slower than this
+    profile_one_in = 0  # profile one in every this many requests with cProfile (0: none)
+    profile_max_files = 200  # number of profiles kept, the oldest are removed
 
     tmp_dir = 'tmp'
 
@@ -96,6 +109,149 @@ def safe_pickle_dump(obj, fname):
         pickle.dump(obj, f, -1)
 
 
+def artifact_generation(paths):
+    """ Identifies a generation of the processed files (pickles, caches, etc.)
+
+    The id changes whenever any of the files is rewritten, which the atomic
+    writes above always do by replacing the file.
+    """
+    h = hashlib.md5()
+    for path in paths:
+        st = os.stat(path)
+        h.update('{:}:{:d}:{:d};'.format(path, st.st_mtime_ns, st.st_size).encode('utf-8'))
+    return h.hexdigest()[:12]
+
+
+class LRUCache(object):
+    """ Thread-safe least recently used cache with a bounded number of entries.
+
+    All the entries belong to one generation of the processed files, and they
+    are dropped as soon as the cache is used with a different generation.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self, generation):
+        with self._lock:
+            if generation != self.generation:
+                self._entries.clear()
+                self.generation = generation
+
+    def get_or_compute(self, key, compute_fn, generation=None):
+        """ Returns the cached value of key, or computes and caches it. A value for another generation
+        than the current one (e.g. for a request still using older files) is computed but not cached. """
+        if generation is not None and generation != self.generation:
+            return compute_fn()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            generation = self.generation
+        # computed outside the lock, so that a slow query does not block the others
+        value = compute_fn()
+        with self._lock:
+            if generation == self.generation:
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'generation': self.generation, 'size': len(self._entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def char_trigrams(word):
+    """ Set of character trigrams of a word, padded so that its start and end also count. """
+    word = '$' + word + '$'
+    return set(word[i:i+3] for i in range(len(word) - 2))
+
+
+def edit_distance(a, b, max_dist):
+    """ Edit distance between a and b, counting the swap of two adjacent characters as a single edit
+    (optimal string alignment). Returns max_dist+1 for any distance larger than max_dist. """
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    prev2, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i]
+        for j in range(1, len(b) + 1):
+            d = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + (a[i-1] != b[j-1]))
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                d = min(d, prev2[j-2] + 1)
+            cur.append(d)
+        if min(cur) > max_dist and (prev2 is None or min(prev) > max_dist):
+            return max_dist + 1
+        prev2, prev = prev, cur
+    return min(prev[-1], max_dist + 1)
+
+
+def htmlsafe_json_dumps(obj):
+    """ Serializes obj to JSON that can also be embedded in a <script> tag, like jinja's tojson filter. """
+    return json.dumps(obj).replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026').replace("'", '\\u0027')
+
+
+# some utilities for creating a search index for faster search, used by make_cache.py
+punc = "'!\"#$%&\'()*+,./:;<=>?@[\\]^_`{|}~'" # removed hyphen from string.punctuation
+trans_table = {ord(c): None for c in punc}
+
+
+def tokenize(s):
+    return s.lower().translate(trans_table).strip().split()
+
+
+def makedict(s, vocab, idf, forceidf=None, scale=1.0):
+    words = set(tokenize(s))
+    idfd = {}
+    for w in words: # bigrams are not included here, they have their own index (see make_cache.py)
+        if forceidf is None:
+            if w in vocab:
+                # we have idf for this
+                idfval = idf[vocab[w]]*scale
+            else:
+                idfval = 1.0*scale # assume idf 1.0 (low)
+        else:
+            idfval = forceidf
+        idfd[w] = idfval
+    return idfd
+
+
+def merge_dicts(dlist):
+    m = {}
+    for d in dlist:
+        for k, v in d.items():
+            m[k] = m.get(k, 0) + v
+    return m
+
+
+def make_search_dict(db, vocab, idf):
+    """ The weight of every word of every paper for the search, from the tfidf vocab and idf of analyze.py. """
+    search_dict = {}
+    for pid,p in db.items():
+        dict_title = makedict(p['title'], vocab, idf, forceidf=5, scale=3)
+        dict_authors = makedict(' '.join(x for x in p['authors']), vocab, idf, forceidf=5)
+        dict_categories = {p['composed_conf_id'].lower(): 5}
+        dict_conf_name = makedict(p['conf_name'], vocab, idf, forceidf=5, scale=3)
+        if 'and' in dict_authors:
+            # special case for "and" handling in authors list
+            del dict_authors['and']
+        dict_summary = makedict(p['summary'], vocab, idf)
+        search_dict[pid] = merge_dicts([dict_title, dict_authors, dict_categories, dict_summary, dict_conf_name])
+    return search_dict
+
+
 def isvalidid(pid):
     return 'favicon' not in pid
 